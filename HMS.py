@@ -1,10 +1,40 @@
 import streamlit as st
-import pandas as pd
-import bcrypt
 from db import *
+import billing
+import cache
+import dedup
+import names
+import resilience
+import routing
+import shards
+import timeline
+
+# pandas, pymysql and bcrypt are imported on first use, so a fresh worker can
+# draw the login form before any of them are loaded.
+def show_table(rows, **kwargs):
+    import pandas as pd
+    st.dataframe(pd.DataFrame(names.enrich(rows), **kwargs))
+
+def show_notes(notes):
+    for field, text in notes.items():
+        st.markdown(f"**{field.capitalize()}**")
+        st.text(text if text is not None else "-")
 
 def main():
     st.title("Hospital Management System")
+    routing.use_session(st.session_state)
+    if resilience.breaker_open():
+        st.warning("The database is not responding. Some pages are unavailable; please try again in a moment.")
+    try:
+        show_main()
+    except DatabaseUnavailable:
+        st.error("The database is temporarily unavailable. Please try again shortly.")
+    except shards.UnknownSite as e:
+        st.error(f"{str(e)} Check the ID and try again.")
+    except shards.BroadcastIncomplete as e:
+        st.warning(f"Saved on {shards.home()['site']}, but not on every site. {str(e)}")
+
+def show_main():
     if 'logged_in' not in st.session_state:
         st.session_state['logged_in'] = False
         st.session_state['role'] = None
@@ -38,6 +68,11 @@ def main():
             st.rerun()
 
         if st.session_state['role'] == 'admin':
+            with st.sidebar.expander("Database health"):
+                st.json(resilience.get_stats())
+                for shard in shards.SHARDS:
+                    if shard['replicas']:
+                        st.json({shard['site']: routing.replica_status(shard['replicas'])})
             show_admin_interface()
         elif st.session_state['role'] == 'doctor':
             show_doctor_interface(st.session_state['user_id'])
@@ -45,9 +80,9 @@ def main():
             show_patient_interface(st.session_state['user_id'])
 
 def show_admin_interface():
-    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
         "Doctors", "Patients", "Appointments", "Bills",
-        "Medications", "Prescriptions", "Medical Records"
+        "Medications", "Prescriptions", "Medical Records", "Occupancy"
     ])
 
     with tab1:
@@ -70,6 +105,7 @@ def show_admin_interface():
                     'password': password
                 }
                 register_doctor(data)
+                cache.expire()
                 st.success("Doctor registered successfully.")
                 first_name = ""
                 last_name = ""
@@ -81,17 +117,17 @@ def show_admin_interface():
             doctor_id = st.number_input("Doctor ID", min_value=0)
             if st.button("Delete Doctor"):
                 delete_doctor(doctor_id)
+                cache.expire()
                 st.success("Doctor deleted successfully.")
                 doctor_id = 0
         elif option == "Doctors List":
-            doctors = get_all_doctors()
+            doctors = cache.get_all('doctor')
             if st.button("Get Doctors"):
-                df = pd.DataFrame(doctors)
-                st.dataframe(df)
+                show_table(doctors)
 
     with tab2:
         st.header("Patients")
-        option = st.selectbox("Select an option", ["Register Patient", "Delete Patient", "Patients List"])
+        option = st.selectbox("Select an option", ["Register Patient", "Delete Patient", "Patients List", "Duplicate Patients"])
         if option == "Register Patient":
             first_name = st.text_input("First Name")
             last_name = st.text_input("Last Name")
@@ -112,8 +148,12 @@ def show_admin_interface():
                     'address': address,
                     'password': password
                 }
-                register_patient(data)
+                new_patient_id = register_patient(data)
                 st.success("Patient registered successfully.")
+                duplicates = dedup.find_candidates(data, exclude=new_patient_id)
+                if duplicates:
+                    st.warning("This patient may already be registered:")
+                    show_table(duplicates)
                 first_name = ""
                 last_name = ""
                 dob = ""
@@ -130,8 +170,19 @@ def show_admin_interface():
         elif option == "Patients List":
             patients = get_all_patients()
             if st.button("Get Patients"):
-                df = pd.DataFrame(patients)
-                st.dataframe(df)
+                show_table(patients)
+        elif option == "Duplicate Patients":
+            if st.button("Find Duplicates"):
+                pairs = dedup.find_all_duplicates()
+                show_table(pairs, columns=["Score", "Patient_ID", "Duplicate_ID"])
+            keep_id = st.number_input("Keep Patient ID", min_value=0)
+            drop_id = st.number_input("Merge Patient ID", min_value=0)
+            if st.button("Merge Patients"):
+                try:
+                    dedup.merge_patients(keep_id, drop_id, actor=('admin', st.session_state['user_id']))
+                    st.success("Patients merged successfully.")
+                except ValueError as e:
+                    st.error(str(e))
 
     with tab3:
         st.header("Appointments")
@@ -148,8 +199,14 @@ def show_admin_interface():
                     'date': date,
                     'time': time
                 }
-                create_apt(data)
-                st.success("Appointment created successfully.")
+                if not doctor_id:
+                    st.error("Enter a doctor ID.")
+                else:
+                    try:
+                        create_apt(data)
+                        st.success("Appointment created successfully.")
+                    except SlotTaken as e:
+                        st.error(str(e))
                 patient_id = 0
                 doctor_id = 0
                 date = None
@@ -158,16 +215,22 @@ def show_admin_interface():
             apt_id = st.number_input("Appointment ID", min_value=0)
             date = st.date_input("New Appointment Date")
             if st.button("Update Appointment Date"):
-                update_aptdate(date, apt_id)
-                st.success("Appointment updated successfully.")
+                try:
+                    update_aptdate(date, apt_id)
+                    st.success("Appointment updated successfully.")
+                except SlotTaken as e:
+                    st.error(str(e))
                 apt_id = 0
                 date = None
         elif option == "Update Appointment Time":
             apt_id = st.number_input("Appointment ID", min_value=0)
             time = st.time_input("New Appointment Time")
             if st.button("Update Appointment Time"):
-                update_apttime(time, apt_id)
-                st.success("Appointment updated successfully.")
+                try:
+                    update_apttime(time, apt_id)
+                    st.success("Appointment updated successfully.")
+                except SlotTaken as e:
+                    st.error(str(e))
                 apt_id = 0
                 time = None
         elif option == "Update Appointment Status":
@@ -187,12 +250,11 @@ def show_admin_interface():
         elif option == "Appointments List":
             appointments = get_all_apts()
             if st.button("Get Appointments"):
-                df = pd.DataFrame(appointments)
-                st.dataframe(df)
+                show_table(appointments)
 
     with tab4:
         st.header("Bills")
-        option = st.selectbox("Select an option", ["Create Bill", "Update Bill Amount", "Update Bill Status", "Get All Bills", "Get Total Amount"])
+        option = st.selectbox("Select an option", ["Create Bill", "Update Bill Amount", "Update Bill Status", "Get All Bills", "Get Total Amount", "Run Billing"])
         if option == "Create Bill":
             create_patient_id = st.number_input("Patient ID", min_value=0, key="create_patient_id")
             bill_date = st.date_input("Bill Date")
@@ -231,20 +293,24 @@ def show_admin_interface():
             if st.button("Get All Bills"):
                 bills = get_all_bills()
                 if bills:
-                    df = pd.DataFrame(bills)
-                    st.dataframe(df)
+                    show_table(bills)
         elif option == "Get Total Amount":
             total_patient_id = st.number_input("Patient_ID", min_value=0, key="total_patient_id")
             if st.button("Get Total Amount"):
                 total = get_totals(total_patient_id)
                 st.write("Total amount:"f"{total}")
+        elif option == "Run Billing":
+            billing_from = st.date_input("Records from", key="billing_from")
+            billing_to = st.date_input("Records to", key="billing_to")
+            if st.button("Run Billing"):
+                result = billing.run_billing(billing_from, billing_to)
+                st.success(f"Billed {result['prescriptions']} prescriptions into {result['bills']} bills.")
 
     with tab5:
         st.header("Medications")
-        meds = get_medicines()
+        meds = cache.get_all('medication')
         if meds:
-            df = pd.DataFrame(meds)
-            st.dataframe(df)
+            show_table(meds)
         st.subheader("Add a new medicine")
         name = st.text_input("Medicine Name")
         dosage = st.text_input("Dosage")
@@ -256,6 +322,7 @@ def show_admin_interface():
                 'price': price
             }
             add_medicine(data)
+            cache.expire()
             st.success("Medicine added successfully.")
             name = ""
             dosage = ""
@@ -265,6 +332,7 @@ def show_admin_interface():
         new_price = st.number_input("New Price", min_value=0.0)
         if st.button("Update Price"):
             update_price(med_id, new_price)
+            cache.expire()
             st.success("Medicine price updated successfully.")
             med_id = 0
             new_price = 0.0
@@ -272,6 +340,7 @@ def show_admin_interface():
         med_id = st.number_input("MEDICINE ID", min_value=0)
         if st.button("Delete Medicine"):
             delete_medicine(med_id)
+            cache.expire()
             st.success("Medicine deleted successfully.")
             med_id = 0
         st.subheader("Update medicine dosage")
@@ -279,9 +348,46 @@ def show_admin_interface():
         new_dosage = st.text_input("New Dosage")
         if st.button("Update Dosage"):
             update_dosage(med_id, new_dosage)
+            cache.expire()
             st.success("Medicine dosage updated successfully.")
             med_id = 0
             new_dosage = ""
+        st.subheader("Stock")
+        low = get_stock(low_only=True)
+        if low:
+            st.warning(f"{len(low)} medicines at or below their reorder level.")
+            show_table(low)
+        if st.checkbox("Show all stock"):
+            show_table(get_stock())
+        sites = [shard['site'] for shard in shards.SHARDS]
+        site = st.selectbox("Site", sites) if len(sites) > 1 else None
+        restock_text = st.text_area("Restock (one 'medicine id, quantity' per line)")
+        if st.button("Restock"):
+            items = {}
+            bad = []
+            for line in filter(None, (line.strip() for line in restock_text.splitlines())):
+                medicine, _, quantity = line.partition(",")
+                try:
+                    medicine, quantity = int(medicine), int(quantity)
+                except ValueError:
+                    bad.append(line)
+                    continue
+                if medicine <= 0 or quantity <= 0:
+                    bad.append(line)
+                    continue
+                items[medicine] = items.get(medicine, 0) + quantity
+            if bad:
+                st.error("Each line must be a medicine ID and a positive quantity, e.g. '12, 100'. Check: " + "; ".join(bad))
+            elif not items:
+                st.error("Enter at least one 'medicine id, quantity' line.")
+            else:
+                restock(items, site)
+                st.success(f"Restocked {len(items)} medicines.")
+        level_med_id = st.number_input("Medicine ID", min_value=0, key="reorder_medicine")
+        level = st.number_input("Reorder level", min_value=0)
+        if st.button("Set Reorder Level"):
+            set_reorder_level(level_med_id, level, site)
+            st.success("Reorder level updated.")
 
     with tab6:
         st.header("Prescriptions")
@@ -305,8 +411,11 @@ def show_admin_interface():
                     'end_date': end_date,
                     'prescription_ID': prescription_ID
                 }
-                create_prescription(data)
-                st.success("Prescription created successfully.")
+                try:
+                    create_prescription(data)
+                    st.success("Prescription created successfully.")
+                except OutOfStock as e:
+                    st.error(str(e))
                 record_id = 0
                 medicine_id = 0
                 quantity = 0
@@ -321,8 +430,7 @@ def show_admin_interface():
             if st.button("Get Prescription"):
                p = get_prescription(record_id, medicine_id)
                if p:
-                df = pd.DataFrame(p)
-                st.dataframe(df)
+                show_table(p)
         elif functionality == "Update Quantity":
             st.subheader("Update medicine quantity")
             record_id = st.number_input("Medical Record Id", min_value=0)
@@ -350,8 +458,7 @@ def show_admin_interface():
         st.header("Medical Records")
         records = get_all_records()
         if records:
-            df = pd.DataFrame(records)
-            st.dataframe(df)
+            show_table(records)
         else:
             st.write("No medical records found.")
         st.subheader("Create a new medical record")
@@ -379,19 +486,47 @@ def show_admin_interface():
         record_id = st.number_input("Record ID", min_value=0)
         diagnosis = st.text_area("New Diagnosis")
         if st.button("Update Diagnosis"):
-            update_diagnosis(record_id, diagnosis)
-            st.success("Diagnosis updated successfully.")
+            if update_diagnosis(record_id, diagnosis, actor=('admin', st.session_state['user_id'])):
+                st.success("Diagnosis updated successfully.")
+            else:
+                st.error(f"No medical record with ID {record_id}.")
             record_id = 0
             diagnosis = ""
         st.subheader("Update treatment")
         record_id = st.number_input("Record_ID", min_value=0)
         treatment = st.text_area("New Treatment")
         if st.button("Update Treatment"):
-            update_treatment(record_id, treatment)
-            st.success("Treatment updated successfully.")
+            if update_treatment(record_id, treatment, actor=('admin', st.session_state['user_id'])):
+                st.success("Treatment updated successfully.")
+            else:
+                st.error(f"No medical record with ID {record_id}.")
             record_id = 0
             treatment = ""
 
+    with tab8:
+        st.header("Occupancy")
+        start_date = st.date_input("From", key="occupancy_from")
+        end_date = st.date_input("To", key="occupancy_to")
+        grain = st.radio("Group by", ["Hour of day", "Date"], horizontal=True)
+        rows = get_occupancy(start_date, end_date, 'hour' if grain == "Hour of day" else 'day')
+        if rows:
+            import altair as alt
+            import pandas as pd
+            dept_names = {d.dept_id: d.department_name for d in cache.get_all('department')}
+            df = pd.DataFrame(rows)
+            df['Department'] = df['Dept_ID'].map(dept_names)
+            df['Slot'] = df['Slot'].astype(str)
+            df['Booked'] = df['Booked'].astype(int)
+            chart = alt.Chart(df).mark_rect().encode(
+                x=alt.X('Slot:O', title=grain),
+                y=alt.Y('Department:N'),
+                color=alt.Color('Booked:Q', scale=alt.Scale(scheme='reds')),
+                tooltip=['Department', 'Slot', 'Booked']
+            )
+            st.altair_chart(chart, use_container_width=True)
+        else:
+            st.write("No appointments booked in this range.")
+
 def show_doctor_interface(doctor_id):
     tab1, tab2, tab3 = st.tabs(["My Appointments", "Patient Records", "Prescriptions"])
 
@@ -399,17 +534,33 @@ def show_doctor_interface(doctor_id):
         st.header("My Appointments")
         appointments = get_doctor_appointments(doctor_id)
         if appointments:
-            df = pd.DataFrame(appointments)
-            st.dataframe(df)
+            show_table(appointments)
 
     with tab2:
         st.header("Patient Records")
         patient_id = st.number_input("Enter Patient ID", min_value=1)
         if st.button("View Records"):
-            records = get_patient_records_for_doctor(doctor_id, patient_id)
-            if records:
-                df = pd.DataFrame(records)
-                st.dataframe(df)
+            # Stack of page positions; the last one is the page on screen.
+            st.session_state['timeline'] = {'patient_id': patient_id, 'pages': [None]}
+        view = st.session_state.get('timeline')
+        if view and view['patient_id'] == patient_id:
+            events, older = timeline.get_page(patient_id, view['pages'][-1], actor=('doctor', doctor_id))
+            if events:
+                show_table(events)
+            else:
+                st.write("No history for this patient.")
+            col1, col2 = st.columns(2)
+            if len(view['pages']) > 1 and col1.button("Newer"):
+                view['pages'].pop()
+                st.rerun()
+            if older and col2.button("Older"):
+                view['pages'].append(older)
+                st.rerun()
+            record_ids = [e.item_id for e in events if e.kind == 'record']
+            if record_ids:
+                record_id = st.selectbox("Open record", record_ids)
+                if st.button("Show Notes"):
+                    show_notes(get_record_notes(record_id, actor=('doctor', doctor_id)))
 
     with tab3:
         st.header("Prescriptions")
@@ -433,8 +584,11 @@ def show_doctor_interface(doctor_id):
                     'end_date': end_date,
                     'prescription_ID': prescription_ID
                 }
-                create_prescription(data)
-                st.success("Prescription created successfully.")
+                try:
+                    create_prescription(data)
+                    st.success("Prescription created successfully.")
+                except OutOfStock as e:
+                    st.error(str(e))
                 record_id = 0
                 medicine_id = 0
                 quantity = 0
@@ -450,36 +604,57 @@ def show_patient_interface(patient_id):
         st.header("My Appointments")
         appointments = get_patient_appointments(patient_id)
         if appointments:
-            df = pd.DataFrame(appointments)
-            st.dataframe(df)
+            show_table(appointments)
 
         st.subheader("Book New Appointment")
+        mode = st.radio("Doctor", ["Choose a doctor", "Any doctor in a department"])
         with st.form("book_appointment"):
-            doctor_id = st.number_input("Doctor ID", min_value=1)
+            if mode == "Choose a doctor":
+                doctor_id = st.number_input("Doctor ID", min_value=1)
+                dept_id = None
+                window_days = 1
+            else:
+                doctor_id = None
+                departments = cache.get_all('department')
+                dept_id = st.selectbox(
+                    "Department",
+                    [d.dept_id for d in departments],
+                    format_func=lambda i: next(d.department_name for d in departments if d.dept_id == i)
+                )
+                window_days = st.number_input("Flexible over how many days", min_value=1, max_value=14)
             date = st.date_input("Appointment Date")
             time = st.time_input("Appointment Time")
             if st.form_submit_button("Book Appointment"):
-                create_apt({
-                    'patient_id': patient_id,
-                    'doctor_id': doctor_id,
-                    'date': date,
-                    'time': time
-                })
-                st.success("Appointment booked successfully!")
+                try:
+                    booked = create_apt({
+                        'patient_id': patient_id,
+                        'doctor_id': doctor_id,
+                        'dept_id': dept_id,
+                        'window_days': window_days,
+                        'date': date,
+                        'time': time
+                    })
+                    if booked:
+                        st.success(f"Appointment booked successfully with doctor {booked[0]} on {booked[1]}!")
+                    else:
+                        st.error("No doctor is available in that department at this time.")
+                except SlotTaken as e:
+                    st.error(str(e))
 
     with tab2:
         st.header("My Medical Records")
-        records = get_medical_records(patient_id)
+        records = get_medical_records(patient_id, actor=('patient', patient_id))
         if records:
-            df = pd.DataFrame(records)
-            st.dataframe(df)
+            show_table(records)
+            record_id = st.selectbox("Open record", [r.record_id for r in records])
+            if st.button("Show Notes"):
+                show_notes(get_record_notes(record_id, actor=('patient', patient_id)))
 
     with tab3:
         st.header("My Bills")
         bills = get_bills(patient_id)
         if bills:
-            df = pd.DataFrame(bills)
-            st.dataframe(df)
+            show_table(bills)
 
         total = get_totals(patient_id)
         st.info(f"Total outstanding amount: ${total}")
@@ -0,0 +1,118 @@
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime
+
+import db
+
+# Events are written by a single background thread with multi-row inserts,
+# either when BATCH_SIZE events are waiting or FLUSH_INTERVAL seconds after the
+# oldest one arrived. One FIFO queue and one writer keep per-record ordering.
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+QUEUE_SIZE = 20000
+# A full queue blocks the caller for at most this long, then the access fails
+# instead of going unaudited.
+PUT_TIMEOUT = 5.0
+# Once shutdown starts, a batch gets SHUTDOWN_ATTEMPTS more tries and stop()
+# waits at most STOP_TIMEOUT seconds, so exit never hangs on a dead database.
+SHUTDOWN_ATTEMPTS = 3
+STOP_TIMEOUT = 10.0
+
+_SQL = """
+    INSERT INTO Audit_Log (Event_Time, Actor_Role, Actor_ID, Action, Patient_ID, Record_ID)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_stop = object()
+_stopping = threading.Event()
+_start_lock = threading.Lock()
+_thread = None
+
+def log(action, actor, patient_id=None, record_id=None):
+    log_many(action, actor, patient_id, [record_id])
+
+def log_many(action, actor, patient_id, record_ids):
+    _ensure_started()
+    role, actor_id = actor if actor else (None, None)
+    now = datetime.now()
+    for record_id in record_ids:
+        _queue.put((now, role, actor_id, action, patient_id, record_id), timeout=PUT_TIMEOUT)
+
+def stop():
+    global _thread
+    with _start_lock:
+        if _thread is None:
+            return
+        _stopping.set()
+        try:
+            _queue.put(_stop, timeout=PUT_TIMEOUT)
+        except queue.Full:
+            # The flusher also checks _stopping whenever the queue runs dry.
+            pass
+        _thread.join(STOP_TIMEOUT)
+        if _thread.is_alive():
+            print(f"Audit flusher still busy after {STOP_TIMEOUT:.0f}s; {_queue.qsize()} events not written.")
+        _thread = None
+
+def _ensure_started():
+    global _thread
+    if _thread is not None:
+        return
+    with _start_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="audit-flusher", daemon=True)
+            _thread.start()
+            atexit.register(stop)
+
+def _run():
+    batch = []
+    deadline = 0.0
+    while True:
+        timeout = max(0.0, deadline - time.monotonic()) if batch else None
+        if _stopping.is_set():
+            timeout = 0.0
+        try:
+            event = _queue.get(timeout=timeout)
+        except queue.Empty:
+            event = _stop if _stopping.is_set() else None
+        if event is _stop:
+            if batch:
+                _write(batch, SHUTDOWN_ATTEMPTS)
+            return
+        if event is not None:
+            if not batch:
+                deadline = time.monotonic() + FLUSH_INTERVAL
+            batch.append(event)
+        if len(batch) >= BATCH_SIZE or (batch and time.monotonic() >= deadline):
+            _write(batch)
+            batch = []
+
+def _write(batch, attempts=None):
+    # Keep retrying the same batch so order is preserved; while we wait the
+    # queue fills up and callers feel the backpressure.
+    delay = 0.5
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            connection = db.get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.executemany(_SQL, batch)
+                connection.commit()
+            finally:
+                connection.close()
+            return
+        except Exception as e:
+            print(f"Audit flush failed: {str(e)}")
+            if _stopping.is_set() and attempts is None:
+                # Shutdown started while this batch was retrying.
+                attempts = attempt + SHUTDOWN_ATTEMPTS
+            if attempts is not None and attempt >= attempts:
+                print(f"Dropping {len(batch)} audit events.")
+                return
+            _stopping.wait(delay)
+            delay = min(delay * 2, 30.0)
@@ -0,0 +1,399 @@
+import gzip
+import json
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import db
+import resilience
+import shards
+
+# Parallel logical backup and restore of one site's hdb database.
+#
+#   python backup.py backup DIR [--site S] [--workers N] [--chunk ROWS]
+#   python backup.py restore DIR [--site S] [--database NAME] [--workers N]
+#                    [--binlog-dir PATH --until "YYYY-MM-DD HH:MM:SS"]
+#
+# Backup: FLUSH TABLES WITH READ LOCK is held only while every worker
+# connection starts a consistent snapshot and the binlog position is read,
+# so all chunks show the same instant and the lock lasts milliseconds. Tables
+# are split into primary-key ranges of about --chunk rows, dumped in parallel
+# as gzipped files of multi-row INSERT statements (one per line), and
+# described in manifest.json.
+#
+# Restore: tables are created without their secondary indexes and loaded in
+# parallel, parents before children as their foreign keys require (ties in
+# hdb.sql order). Indexes, then triggers and procedures, are added once the
+# data is in. With --binlog-dir and --until the binlogs from the backup's
+# position are replayed through mysqlbinlog and mysql up to that time.
+
+WORKERS = 4
+CHUNK_ROWS = 50000
+# Each INSERT line stays well under the server's max_allowed_packet.
+STATEMENT_BYTES = 1 << 20
+COMPRESS_LEVEL = 3
+
+_HDB_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hdb.sql")
+_SECONDARY_KEY = re.compile(r"^\s*(UNIQUE |FULLTEXT |SPATIAL )?KEY ")
+_INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+
+def _connect(config):
+    import pymysql
+
+    # Batch tool: no deadline, no statement timeout, and always the primary.
+    with resilience.deadline(None):
+        return pymysql.connect(**config, **resilience.connect_kwargs())
+
+def _site_config(site):
+    return dict((shards.shard_for_site(site) if site else shards.home())['config'])
+
+def _quote(name):
+    return "`" + name.replace("`", "``") + "`"
+
+def _hdb_order():
+    try:
+        with open(_HDB_SQL) as f:
+            names = re.findall(r"CREATE TABLE (\w+)", f.read(), re.IGNORECASE)
+    except OSError:
+        names = []
+    return {name.lower(): i for i, name in enumerate(names)}
+
+def _levels(tables, depends):
+    # Groups tables so each group only references tables in earlier groups.
+    order = _hdb_order()
+    position = lambda name: (order.get(name.lower(), len(order)), name)
+    done = set()
+    levels = []
+    left = set(tables)
+    while left:
+        ready = sorted((t for t in left if all(p in done or p == t or p not in left for p in depends.get(t, []))), key=position)
+        if not ready:
+            raise ValueError(f"Circular foreign keys between {', '.join(sorted(left))}.")
+        levels.append(ready)
+        done.update(ready)
+        left.difference_update(ready)
+    return levels
+
+def _split_create(create):
+    # CREATE TABLE without its secondary indexes, plus those index definitions.
+    lines = create.splitlines()
+    body = [line.strip().rstrip(",") for line in lines[1:-1]]
+    keys = [line for line in body if _SECONDARY_KEY.match(line)]
+    kept = [line for line in body if not _SECONDARY_KEY.match(line)]
+    return "\n".join([lines[0]] + [",\n".join("  " + line for line in kept)] + [lines[-1]]), keys
+
+def _literal(connection, value):
+    if isinstance(value, (bytes, bytearray)):
+        return "X'" + value.hex() + "'" if value else "''"
+    return connection.escape(value)
+
+def _read_schema(cursor):
+    cursor.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'")
+    tables = {}
+    for (name,) in cursor.fetchall():
+        cursor.execute("SHOW CREATE TABLE " + _quote(name))
+        create, keys = _split_create(cursor.fetchone()[1])
+        cursor.execute("""
+            SELECT COLUMN_NAME, DATA_TYPE, COLUMN_KEY FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION
+        """, (name,))
+        columns = cursor.fetchall()
+        cursor.execute("""
+            SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY'
+            ORDER BY ORDINAL_POSITION
+        """, (name,))
+        primary = [row[0] for row in cursor.fetchall()]
+        types = {column: data_type for column, data_type, key in columns}
+        tables[name] = {
+            'columns': [column for column, data_type, key in columns],
+            'primary': primary,
+            # Chunked by the first primary key column when it is an integer.
+            'chunk_column': primary[0] if primary and types[primary[0]] in _INTEGER_TYPES else None,
+            'create': create,
+            'keys': keys,
+            'depends': [],
+            'chunks': [],
+        }
+    cursor.execute("""
+        SELECT TABLE_NAME, REFERENCED_TABLE_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE()
+    """)
+    for child, parent in cursor.fetchall():
+        if child in tables and parent != child and parent not in tables[child]['depends']:
+            tables[child]['depends'].append(parent)
+    post = []
+    cursor.execute("SHOW TRIGGERS")
+    for row in cursor.fetchall():
+        cursor.execute("SHOW CREATE TRIGGER " + _quote(row[0]))
+        post.append(cursor.fetchone()[2])
+    for kind in ("PROCEDURE", "FUNCTION"):
+        cursor.execute("SELECT ROUTINE_NAME FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = DATABASE() AND ROUTINE_TYPE = %s", (kind,))
+        for (name,) in cursor.fetchall():
+            cursor.execute(f"SHOW CREATE {kind} " + _quote(name))
+            post.append(cursor.fetchone()[2])
+    return tables, post
+
+def _binlog_position(cursor):
+    for sql in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+        try:
+            cursor.execute(sql)
+        except Exception:
+            continue
+        row = cursor.fetchone()
+        if row:
+            return {'file': row[0], 'position': row[1], 'gtid': row[4] if len(row) > 4 else None}
+        return None
+    return None
+
+def _plan_chunks(cursor, name, table, chunk_rows):
+    column = table['chunk_column']
+    if column is None:
+        return [None]
+    cursor.execute(f"SELECT MIN({_quote(column)}), MAX({_quote(column)}) FROM {_quote(name)}")
+    low, high = cursor.fetchone()
+    if low is None:
+        return []
+    return [(start, min(start + chunk_rows - 1, high)) for start in range(low, high + 1, chunk_rows)]
+
+def _dump_chunk(connection, directory, name, table, number, bounds):
+    select = "SELECT " + ", ".join(_quote(c) for c in table['columns']) + " FROM " + _quote(name)
+    args = None
+    if bounds is not None:
+        select += f" WHERE {_quote(table['chunk_column'])} BETWEEN %s AND %s"
+        args = bounds
+    if table['primary']:
+        select += " ORDER BY " + ", ".join(_quote(c) for c in table['primary'])
+    prefix = "INSERT INTO " + _quote(name) + " (" + ", ".join(_quote(c) for c in table['columns']) + ") VALUES "
+    filename = f"{name}.{number:05d}.sql.gz"
+    rows = 0
+    raw_bytes = 0
+    with connection.cursor() as cursor, gzip.open(os.path.join(directory, filename), "wt", encoding="utf-8", compresslevel=COMPRESS_LEVEL) as out:
+        cursor.execute(select, args)
+        values = []
+        size = 0
+        while True:
+            batch = cursor.fetchmany(1000)
+            for row in batch:
+                value = "(" + ",".join(_literal(connection, v) for v in row) + ")"
+                values.append(value)
+                size += len(value) + 1
+                if size >= STATEMENT_BYTES:
+                    line = prefix + ",".join(values) + ";\n"
+                    out.write(line)
+                    raw_bytes += len(line)
+                    values, size = [], 0
+            rows += len(batch)
+            if not batch:
+                break
+        if values:
+            line = prefix + ",".join(values) + ";\n"
+            out.write(line)
+            raw_bytes += len(line)
+    if not rows:
+        os.remove(os.path.join(directory, filename))
+        return None
+    return {'file': filename, 'rows': rows, 'raw_bytes': raw_bytes, 'bytes': os.path.getsize(os.path.join(directory, filename))}
+
+def _run_workers(connections, tasks, work):
+    # One thread per connection, each taking tasks until none are left.
+    pending = queue.Queue()
+    for task in tasks:
+        pending.put(task)
+    results = []
+    errors = []
+
+    def worker(connection):
+        while not errors:
+            try:
+                task = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.append((task, work(connection, task)))
+            except Exception as e:
+                errors.append((task, e))
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in connections]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        task, e = errors[0]
+        raise RuntimeError(f"{task} failed: {str(e)}") from e
+    return results
+
+def backup(directory, site=None, workers=WORKERS, chunk_rows=CHUNK_ROWS):
+    config = _site_config(site)
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, "manifest.json")):
+        raise SystemExit(f"{directory} already holds a backup.")
+    started = time.monotonic()
+    coordinator = _connect(config)
+    connections = [_connect(config) for _ in range(workers)]
+    try:
+        with coordinator.cursor() as cursor:
+            cursor.execute("FLUSH TABLES WITH READ LOCK")
+            try:
+                for connection in connections:
+                    with connection.cursor() as worker_cursor:
+                        worker_cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                        worker_cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                binlog = _binlog_position(cursor)
+                tables, post = _read_schema(cursor)
+            finally:
+                cursor.execute("UNLOCK TABLES")
+        locked = time.monotonic() - started
+
+        tasks = []
+        with connections[0].cursor() as cursor:
+            for name, table in tables.items():
+                for number, bounds in enumerate(_plan_chunks(cursor, name, table, chunk_rows)):
+                    tasks.append((name, number, bounds))
+        results = _run_workers(connections, tasks, lambda connection, task: _dump_chunk(
+            connection, directory, task[0], tables[task[0]], task[1], task[2]
+        ))
+    finally:
+        for connection in connections + [coordinator]:
+            connection.close()
+    for (name, number, bounds), chunk in sorted(results, key=lambda r: (r[0][0], r[0][1])):
+        if chunk:
+            tables[name]['chunks'].append(chunk)
+
+    elapsed = time.monotonic() - started
+    manifest = {
+        'created': datetime.now().isoformat(timespec="seconds"),
+        'site': site or shards.home()['site'],
+        'database': config['database'],
+        'binlog': binlog,
+        'tables': tables,
+        'post': post,
+    }
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1, default=str)
+    return _report("backup", tables, elapsed, locked_seconds=locked)
+
+def _report(phase, tables, elapsed, **extra):
+    chunks = [c for table in tables.values() for c in table['chunks']]
+    rows = sum(c['rows'] for c in chunks)
+    raw = sum(c['raw_bytes'] for c in chunks)
+    report = {
+        'phase': phase,
+        'tables': len(tables),
+        'chunks': len(chunks),
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed if elapsed else None,
+        'mb_per_second': raw / elapsed / 1e6 if elapsed else None,
+        'compressed_mb': sum(c['bytes'] for c in chunks) / 1e6,
+        'compression_ratio': raw / sum(c['bytes'] for c in chunks) if chunks else None,
+    }
+    report.update(extra)
+    return report
+
+def _load_chunk(connection, directory, chunk):
+    with connection.cursor() as cursor, gzip.open(os.path.join(directory, chunk['file']), "rt", encoding="utf-8") as lines:
+        for line in lines:
+            cursor.execute(line)
+    connection.commit()
+    return chunk['rows']
+
+def restore(directory, site=None, database=None, workers=WORKERS, binlog_dir=None, until=None):
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    config = _site_config(site)
+    database = database or manifest['database']
+    tables = manifest['tables']
+    started = time.monotonic()
+
+    admin = _connect(dict(config, database=None))
+    try:
+        with admin.cursor() as cursor:
+            cursor.execute("CREATE DATABASE IF NOT EXISTS " + _quote(database))
+            cursor.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s", (database,))
+            if cursor.fetchone()[0]:
+                raise SystemExit(f"Database {database} is not empty.")
+    finally:
+        admin.close()
+
+    config['database'] = database
+    connections = [_connect(config) for _ in range(workers)]
+    try:
+        loaded = time.monotonic()
+        depends = {name: table['depends'] for name, table in tables.items()}
+        for level in _levels(list(tables), depends):
+            with connections[0].cursor() as cursor:
+                for name in level:
+                    cursor.execute(tables[name]['create'])
+            tasks = [chunk['file'] for name in level for chunk in tables[name]['chunks']]
+            by_file = {chunk['file']: chunk for name in level for chunk in tables[name]['chunks']}
+            _run_workers(connections, tasks, lambda connection, task: _load_chunk(connection, directory, by_file[task]))
+        load_seconds = time.monotonic() - loaded
+
+        indexed = time.monotonic()
+        tasks = [name for name, table in tables.items() if table['keys']]
+        _run_workers(connections, tasks, lambda connection, name: connection.cursor().execute(
+            "ALTER TABLE " + _quote(name) + " " + ", ".join("ADD " + key for key in tables[name]['keys'])
+        ))
+        index_seconds = time.monotonic() - indexed
+
+        with connections[0].cursor() as cursor:
+            for statement in manifest['post']:
+                cursor.execute(statement)
+        connections[0].commit()
+    finally:
+        for connection in connections:
+            connection.close()
+
+    if binlog_dir and until:
+        replay_binlogs(manifest, config, binlog_dir, until)
+    return _report("restore", tables, time.monotonic() - started, load_seconds=load_seconds, index_seconds=index_seconds)
+
+def replay_binlogs(manifest, config, binlog_dir, until):
+    # Point-in-time recovery: binlog events after the backup's position, up
+    # to `until`, applied with the MySQL client tools.
+    binlog = manifest.get('binlog')
+    if not binlog:
+        raise SystemExit("The backup was taken with binary logging off; it cannot be rolled forward.")
+    base = binlog['file'].rsplit(".", 1)[0]
+    files = sorted(
+        name for name in os.listdir(binlog_dir)
+        if name.rsplit(".", 1)[0] == base and name.rsplit(".", 1)[-1].isdigit() and name >= binlog['file']
+    )
+    options = [f"--start-position={binlog['position']}", f"--stop-datetime={until}", f"--database={manifest['database']}"]
+    if config['database'] != manifest['database']:
+        options.append(f"--rewrite-db={manifest['database']}->{config['database']}")
+    read = subprocess.Popen(
+        ["mysqlbinlog"] + options + [os.path.join(binlog_dir, name) for name in files],
+        stdout=subprocess.PIPE
+    )
+    apply = subprocess.run(
+        ["mysql", f"--host={config['host']}", f"--port={config.get('port', 3306)}", f"--user={config['user']}", config['database']],
+        stdin=read.stdout, env=dict(os.environ, MYSQL_PWD=config['password'])
+    )
+    read.stdout.close()
+    if read.wait() or apply.returncode:
+        raise SystemExit("Binlog replay failed.")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {'--site': None, '--workers': str(WORKERS), '--chunk': str(CHUNK_ROWS), '--database': None, '--binlog-dir': None, '--until': None}
+    for name in list(options):
+        if name in args:
+            i = args.index(name)
+            options[name] = args[i + 1]
+            del args[i:i + 2]
+    if len(args) != 2 or args[0] not in ("backup", "restore"):
+        raise SystemExit("usage: python backup.py backup|restore DIR [options]")
+    if args[0] == "backup":
+        report = backup(args[1], options['--site'], int(options['--workers']), int(options['--chunk']))
+    else:
+        report = restore(args[1], options['--site'], options['--database'], int(options['--workers']), options['--binlog-dir'], options['--until'])
+    for key, value in report.items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
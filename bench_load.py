@@ -0,0 +1,235 @@
+import json
+import multiprocessing
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, time as time_of_day, timedelta
+
+# Concurrent-session load test for HMS.py. Every simulated user is a headless
+# AppTest session clicking through a role's usual path; each run() is one
+# Streamlit rerun, the same work a browser interaction costs the server.
+#
+#   python bench_load.py users.json [levels] [--seconds 30] [--processes 1]
+#                        [--label v1.4] [--output bench_output.txt]
+#
+# users.json holds logins per role and the patients doctors look up:
+#   {"admin": [{"email": "...", "password": "..."}],
+#    "doctor": [...], "patient": [...], "patient_ids": [1, 2, 3]}
+#
+# levels is a comma-separated list of sessions per role (default 1,2,4,8,16).
+# Each level starts fresh worker processes, like restarting the server, so
+# the rows form a saturation curve; --output appends them as JSON lines to
+# compare against earlier releases.
+
+ROLES = ("admin", "doctor", "patient")
+
+_counts = {'connections': 0, 'queries': 0}
+_counts_lock = threading.Lock()
+
+def _count(key):
+    with _counts_lock:
+        _counts[key] += 1
+
+def _instrument():
+    # Counts connections opened and statements sent by everything in this
+    # process, app and cache/audit threads alike.
+    import pymysql
+
+    connect = pymysql.connections.Connection.connect
+    execute = pymysql.cursors.Cursor.execute
+
+    def counting_connect(self, *args, **kwargs):
+        _count('connections')
+        return connect(self, *args, **kwargs)
+
+    def counting_execute(self, *args, **kwargs):
+        _count('queries')
+        return execute(self, *args, **kwargs)
+
+    pymysql.connections.Connection.connect = counting_connect
+    pymysql.cursors.Cursor.execute = counting_execute
+
+def _labelled(elements, label, option=None):
+    # Widgets in HMS.py have no keys; several tabs reuse the same label, so
+    # an expected option tells them apart.
+    for element in elements:
+        if element.label == label and (option is None or option in element.options):
+            return element
+    raise LookupError(f"No widget labelled {label!r}.")
+
+def _login(at, user):
+    at.text_input[0].input(user['email'])
+    at.text_input[1].input(user['password'])
+    _labelled(at.button, "Login").click()
+
+def _admin_path(at, rng, users):
+    yield "open", lambda: None
+    for option, button in (("Doctors List", "Get Doctors"), ("Patients List", "Get Patients"), ("Appointments List", "Get Appointments")):
+        yield "select " + option, lambda option=option: _labelled(at.selectbox, "Select an option", option).select(option)
+        yield button, lambda button=button: _labelled(at.button, button).click()
+    yield "occupancy by date", lambda: _labelled(at.radio, "Group by").set_value("Date")
+
+def _doctor_path(at, rng, users):
+    yield "open", lambda: None
+    patient_id = rng.choice(users.get('patient_ids') or [1])
+    yield "patient id", lambda: _labelled(at.number_input, "Enter Patient ID").set_value(patient_id)
+    yield "View Records", lambda: _labelled(at.button, "View Records").click()
+    yield "select Get Prescription", lambda: _labelled(at.selectbox, "Select a functionality", "Get Prescription").select("Get Prescription")
+
+def _patient_path(at, rng, users):
+    yield "open", lambda: None
+
+    yield "any doctor", lambda: _labelled(at.radio, "Doctor").set_value("Any doctor in a department")
+
+    def book():
+        _labelled(at.date_input, "Appointment Date").set_value(date.today() + timedelta(days=rng.randint(1, 14)))
+        _labelled(at.time_input, "Appointment Time").set_value(time_of_day(rng.randint(9, 16)))
+        _labelled(at.button, "Book Appointment").click()
+    yield "Book Appointment", book
+
+PATHS = {'admin': _admin_path, 'doctor': _doctor_path, 'patient': _patient_path}
+
+def _session(role, user, users, seed, stop, samples, errors):
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(seed)
+    while time.monotonic() < stop:
+        at = AppTest.from_file("HMS.py", default_timeout=60)
+        steps = [("login form", lambda: None), ("login", lambda: _login(at, user))]
+        steps += list(PATHS[role](at, rng, users))
+        steps.append(("logout", lambda: _labelled(at.sidebar.button, "Logout").click()))
+        for step, act in steps:
+            if time.monotonic() >= stop:
+                return
+            try:
+                act()
+                started = time.perf_counter()
+                at.run()
+                samples.append((role, step, time.perf_counter() - started))
+                if at.exception:
+                    errors.append((role, step, str(at.exception[0].value)))
+                    break
+            except Exception as e:
+                errors.append((role, step, str(e)))
+                break
+
+def _worker(users, sessions, seconds, seed):
+    # One server process: `sessions` maps role -> how many of its users run
+    # here concurrently.
+    _instrument()
+    import resilience
+
+    samples = []
+    errors = []
+    stop = time.monotonic() + seconds
+    threads = []
+    for role, count in sessions.items():
+        for i in range(count):
+            user = users[role][i % len(users[role])]
+            threads.append(threading.Thread(
+                target=_session, args=(role, user, users, seed + len(threads), stop, samples, errors)
+            ))
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'elapsed': elapsed,
+        'samples': samples,
+        'errors': errors,
+        'connections': _counts['connections'],
+        'queries': _counts['queries'],
+        'db_calls': resilience.get_stats()['calls'],
+        'cpu_seconds': (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime),
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+    }
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def run_level(users, per_role, seconds=30, processes=1):
+    shares = []
+    for p in range(processes):
+        shares.append({role: per_role // processes + (1 if p < per_role % processes else 0) for role in ROLES})
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes) as pool:
+        results = pool.starmap(_worker, [(users, share, seconds, 1000 * p) for p, share in enumerate(shares)])
+
+    samples = [s for r in results for s in r['samples']]
+    latencies = [s[2] for s in samples]
+    interactions = len(samples) or 1
+    elapsed = max(r['elapsed'] for r in results)
+    level = {
+        'sessions_per_role': per_role,
+        'sessions': per_role * len(ROLES),
+        'processes': processes,
+        'interactions': len(samples),
+        'errors': sum(len(r['errors']) for r in results),
+        'interactions_per_second': len(samples) / elapsed,
+        'p50_ms': 1000 * statistics.median(latencies) if latencies else None,
+        'p95_ms': 1000 * _percentile(latencies, 0.95) if latencies else None,
+        'p99_ms': 1000 * _percentile(latencies, 0.99) if latencies else None,
+        'connections_per_interaction': sum(r['connections'] for r in results) / interactions,
+        'queries_per_interaction': sum(r['queries'] for r in results) / interactions,
+        'db_calls_per_interaction': sum(r['db_calls'] for r in results) / interactions,
+        'cpu_percent_per_process': [100 * r['cpu_seconds'] / r['elapsed'] for r in results],
+        'peak_rss_mb_per_process': [r['peak_rss_mb'] for r in results],
+    }
+    by_step = {}
+    for role, step, latency in samples:
+        by_step.setdefault(f"{role}: {step}", []).append(latency)
+    level['by_step_p95_ms'] = {key: 1000 * _percentile(values, 0.95) for key, values in sorted(by_step.items())}
+    first_errors = [e for r in results for e in r['errors']][:5]
+    if first_errors:
+        level['sample_errors'] = first_errors
+    return level
+
+def _git_label():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(users, levels=(1, 2, 4, 8, 16), seconds=30, processes=1):
+    missing = [role for role in ROLES if not users.get(role)]
+    if missing:
+        raise SystemExit(f"No users for: {', '.join(missing)}.")
+    return [run_level(users, n, seconds, processes) for n in levels]
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {'--seconds': '30', '--processes': '1', '--label': None, '--output': None}
+    for name in list(options):
+        if name in args:
+            i = args.index(name)
+            options[name] = args[i + 1]
+            del args[i:i + 2]
+    if not args:
+        raise SystemExit("usage: python bench_load.py users.json [levels] [--seconds N] [--processes N] [--label L] [--output FILE]")
+    with open(args[0]) as f:
+        users = json.load(f)
+    levels = [int(n) for n in args[1].split(",")] if len(args) > 1 else [1, 2, 4, 8, 16]
+    label = options['--label'] or _git_label()
+
+    print(f"{'sessions':>8} {'int/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'conn/int':>9} {'qry/int':>8} {'cpu %':>7} {'rss MB':>7} {'errors':>6}")
+    for level in run(users, levels, float(options['--seconds']), int(options['--processes'])):
+        print(
+            f"{level['sessions']:>8} {level['interactions_per_second']:>8.1f} "
+            f"{level['p50_ms'] or 0:>8.0f} {level['p95_ms'] or 0:>8.0f} {level['p99_ms'] or 0:>8.0f} "
+            f"{level['connections_per_interaction']:>9.1f} {level['queries_per_interaction']:>8.1f} "
+            f"{max(level['cpu_percent_per_process']):>7.0f} {max(level['peak_rss_mb_per_process']):>7.0f} {level['errors']:>6}"
+        )
+        if options['--output']:
+            with open(options['--output'], "a") as f:
+                f.write(json.dumps(dict(level, bench="load", label=label, time=time.time())) + "\n")
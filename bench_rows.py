@@ -0,0 +1,54 @@
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from models import Appointment
+
+# Memory and attribute-access cost of the row types in models.py against the
+# DictCursor dicts db.py used to return, on a synthetic Appointments result.
+#
+#   python bench_rows.py [rows]
+
+_COLUMNS = ["Appointment_ID", "Patient_ID", "Doctor_ID", "Appointment_Date", "Appointment_Time", "Appointment_Status"]
+
+def _tuples(n):
+    start = date(2020, 1, 1)
+    return [
+        (i, i % 50000, i % 300, start + timedelta(days=i % 1500), timedelta(hours=9 + i % 8), "Upcoming")
+        for i in range(n)
+    ]
+
+def _measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rows = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return rows, after - before
+
+def run(n=200000):
+    raw = _tuples(n)
+    dicts, dict_bytes = _measure(lambda: [dict(zip(_COLUMNS, row)) for row in raw])
+    typed, typed_bytes = _measure(lambda: [Appointment._make(row) for row in raw])
+
+    t = time.perf_counter()
+    sum(row["Doctor_ID"] for row in dicts)
+    dict_access = time.perf_counter() - t
+    t = time.perf_counter()
+    sum(row.doctor_id for row in typed)
+    typed_access = time.perf_counter() - t
+
+    return {
+        "rows": n,
+        "dict_bytes_per_row": dict_bytes / n,
+        "typed_bytes_per_row": typed_bytes / n,
+        "memory_saved": 1 - typed_bytes / dict_bytes,
+        "dict_access_ns": 1e9 * dict_access / n,
+        "typed_access_ns": 1e9 * typed_access / n,
+    }
+
+if __name__ == "__main__":
+    result = run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    for key, value in result.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
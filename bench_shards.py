@@ -0,0 +1,63 @@
+import random
+import sys
+import threading
+import time
+from datetime import date
+
+import db
+import shards
+
+# Throughput of patient-scoped traffic across the configured sites. Run it
+# with HMS_SHARDS listing 1, 2, 4... local MySQL instances (each loaded with
+# hdb.sql and some patients) and compare ops/s:
+#
+#   HMS_SHARDS=sites.json python bench_shards.py [threads] [seconds]
+#
+# Each operation is a bill insert plus a read of that patient's bills, both
+# routed to the patient's site.
+
+def run(threads=16, seconds=20):
+    patient_ids = [p.patient_id for p in db.get_all_patients()]
+    if not patient_ids:
+        raise SystemExit("No patients to run against.")
+    per_site = {}
+    for pid in patient_ids:
+        site = shards.shard_for_id(pid)['site']
+        per_site[site] = per_site.get(site, 0) + 1
+
+    done = [0] * threads
+    errors = [0] * threads
+    stop = time.monotonic() + seconds
+
+    def worker(i):
+        rng = random.Random(i)
+        while time.monotonic() < stop:
+            pid = rng.choice(patient_ids)
+            try:
+                db.create_bill({'patient_id': pid, 'bill_date': date.today(), 'payment_status': 'Unpaid', 'amount': 1})
+                db.get_bills(pid)
+                done[i] += 1
+            except Exception:
+                errors[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.monotonic()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.monotonic() - started
+    return {
+        'sites': len(shards.SHARDS),
+        'patients_per_site': per_site,
+        'threads': threads,
+        'ops': sum(done),
+        'errors': sum(errors),
+        'ops_per_second': sum(done) / elapsed,
+    }
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    for key, value in run(threads, seconds).items():
+        print(f"{key}: {value:.1f}" if isinstance(value, float) else f"{key}: {value}")
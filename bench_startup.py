@@ -0,0 +1,76 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold-start benchmark for HMS.py. Every sample runs in a fresh interpreter so
+# nothing is already in sys.modules, like a newly started Streamlit worker.
+#
+#   python bench_startup.py [runs] [--output bench_output.txt]
+
+HEAVY_MODULES = ["pandas", "pymysql", "bcrypt", "altair"]
+
+_IMPORT_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import streamlit
+t_streamlit = time.perf_counter() - t
+t = time.perf_counter()
+import db, cache, dedup
+t_app = time.perf_counter() - t
+print(json.dumps({
+    "streamlit_import": t_streamlit,
+    "app_import": t_app,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+_RENDER_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("HMS.py", default_timeout=60)
+at.run()
+elapsed = time.perf_counter() - t
+print(json.dumps({
+    "first_render": elapsed,
+    "login_form": len(at.text_input) >= 2,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+def _probe(code):
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - started
+    return result
+
+def run(runs=5):
+    imports = [_probe(_IMPORT_PROBE) for _ in range(runs)]
+    renders = [_probe(_RENDER_PROBE) for _ in range(runs)]
+    return {
+        "runs": runs,
+        "streamlit_import_ms": 1000 * statistics.median(r["streamlit_import"] for r in imports),
+        "app_import_ms": 1000 * statistics.median(r["app_import"] for r in imports),
+        "first_render_ms": 1000 * statistics.median(r["first_render"] for r in renders),
+        "render_process_ms": 1000 * statistics.median(r["process"] for r in renders),
+        "heavy_loaded_at_import": imports[0]["loaded"],
+        "heavy_loaded_at_login": renders[0]["loaded"],
+        "login_form_rendered": all(r["login_form"] for r in renders),
+    }
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    output = None
+    if "--output" in args:
+        i = args.index("--output")
+        output = args[i + 1]
+        del args[i:i + 2]
+    result = run(int(args[0]) if args else 5)
+    for key, value in result.items():
+        print(f"{key}: {value:.1f}" if isinstance(value, float) else f"{key}: {value}")
+    if output:
+        with open(output, "a") as f:
+            f.write(json.dumps(dict(result, bench="startup", time=time.time())) + "\n")
@@ -0,0 +1,71 @@
+import sys
+import threading
+import time
+
+import db
+
+# Stock decrement throughput under contention: every thread takes one unit
+# of the same medicine per transaction, as a burst of prescriptions for one
+# popular drug would. Run against a test database loaded with hdb.sql:
+#
+#   python bench_stock.py [threads] [seconds] [stripes,...]
+#
+# Each stripe count gets a fresh throwaway medicine, stocked well above what
+# the run can use, and is compared on commits/s.
+
+def run_stripes(stripes, threads=16, seconds=10):
+    db.STOCK_STRIPES = stripes
+    medicine_id = db.add_medicine({'name': f"bench stock {stripes}", 'dosage': "-", 'price': 0})
+    db.restock({medicine_id: 10_000_000})
+    done = [0] * threads
+    errors = [0] * threads
+    stop = time.monotonic() + seconds
+
+    def worker(i):
+        connection = db.get_connection()
+        try:
+            while time.monotonic() < stop:
+                try:
+                    with connection.cursor() as cursor:
+                        db.take_stock(cursor, {medicine_id: 1})
+                    connection.commit()
+                    done[i] += 1
+                except Exception:
+                    connection.rollback()
+                    errors[i] += 1
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.monotonic()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.monotonic() - started
+    # Read back from the primary; get_stock may be served by a lagging replica.
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT SUM(Quantity) AS Quantity FROM Medication_Stock WHERE Medicine_ID = %s", (medicine_id,))
+            left = cursor.fetchone()['Quantity']
+    finally:
+        connection.close()
+    db.delete_medicine(medicine_id)
+    return {
+        'stripes': stripes,
+        'threads': threads,
+        'commits': sum(done),
+        'errors': sum(errors),
+        'commits_per_second': sum(done) / elapsed,
+        # Every commit took exactly one unit.
+        'consistent': left == 10_000_000 - sum(done),
+    }
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    counts = [int(n) for n in sys.argv[3].split(",")] if len(sys.argv) > 3 else [1, db.STOCK_STRIPES]
+    for stripes in counts:
+        result = run_stripes(stripes, threads, seconds)
+        print(", ".join(f"{key}: {value:.1f}" if isinstance(value, float) else f"{key}: {value}" for key, value in result.items()))
@@ -0,0 +1,83 @@
+import sys
+import time
+
+import db
+import resilience
+import shards
+
+BATCH_SIZE = 5000
+
+# Claim the unbilled prescriptions of one Record_ID range. The UPDATE takes row
+# locks, so a concurrent run for an overlapping range waits and then finds
+# nothing left to claim.
+_SQL_CLAIM = """
+    UPDATE prescriptions AS pr
+    INNER JOIN medical_record AS mr ON mr.Record_ID = pr.Record_ID
+    SET pr.Billing_Run_ID = %s
+    WHERE mr.Record_ID BETWEEN %s AND %s
+    AND mr.Record_Date BETWEEN %s AND %s
+    AND pr.Billing_Run_ID IS NULL
+"""
+
+# One bill per medical record for everything this run claimed in the range.
+_SQL_BILL = """
+    INSERT INTO Bills (Patient_ID, Record_ID, Billing_Run_ID, Bill_Date, Payment_Status, Amount)
+    SELECT mr.Patient_ID, mr.Record_ID, %s, CURDATE(), 'Unpaid', SUM(COALESCE(pr.Quantity, 0) * m.Price)
+    FROM prescriptions AS pr
+    INNER JOIN medical_record AS mr ON mr.Record_ID = pr.Record_ID
+    INNER JOIN medications AS m ON m.Medicine_ID = pr.Medicine_ID
+    WHERE pr.Billing_Run_ID = %s
+    AND mr.Record_ID BETWEEN %s AND %s
+    GROUP BY mr.Record_ID, mr.Patient_ID
+"""
+
+def run_billing(start_date, end_date, batch_size=BATCH_SIZE):
+    # Each site bills its own patients, all sites in parallel.
+    results = shards.run_all(lambda: _run_site_billing(start_date, end_date, batch_size))
+    return {
+        'run_ids': {shard['site']: result['run_id'] for shard, result in zip(shards.SHARDS, results)},
+        'prescriptions': sum(result['prescriptions'] for result in results),
+        'bills': sum(result['bills'] for result in results),
+        'seconds': max(result['seconds'] for result in results),
+    }
+
+def _run_site_billing(start_date, end_date, batch_size):
+    with resilience.deadline(None):
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            started = time.monotonic()
+            sql = "INSERT INTO Billing_Runs (Started_At, From_Date, To_Date) VALUES (NOW(), %s, %s)"
+            cursor.execute(sql, (start_date, end_date))
+            run_id = cursor.lastrowid
+            sql = """
+                SELECT MIN(Record_ID) AS lo, MAX(Record_ID) AS hi
+                FROM medical_record
+                WHERE Record_Date BETWEEN %s AND %s
+            """
+            cursor.execute(sql, (start_date, end_date))
+            bounds = cursor.fetchone()
+            connection.commit()
+
+            prescriptions = 0
+            bills = 0
+            if bounds['lo'] is not None:
+                for lo in range(bounds['lo'], bounds['hi'] + 1, batch_size):
+                    hi = lo + batch_size - 1
+                    claimed = cursor.execute(_SQL_CLAIM, (run_id, lo, hi, start_date, end_date))
+                    if claimed:
+                        bills += cursor.execute(_SQL_BILL, (run_id, run_id, lo, hi))
+                        prescriptions += claimed
+                    connection.commit()
+
+            cursor.execute("UPDATE Billing_Runs SET Bills_Created = %s WHERE Billing_Run_ID = %s", (bills, run_id))
+            connection.commit()
+            elapsed = time.monotonic() - started
+            print(f"Billing run {run_id} at {shards.current()['site']}: {prescriptions} prescriptions, {bills} bills in {elapsed:.1f}s.")
+            return {'run_id': run_id, 'prescriptions': prescriptions, 'bills': bills, 'seconds': elapsed}
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    start, end = sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else sys.argv[1]
+    run_billing(start, end)
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import db
+import routing
+import shards
+from models import Department, Doctor, Medication, fetch_all
+
+# Upper bound (seconds) on how long a row changed by another server process
+# can stay stale here.
+POLL_INTERVAL = 2.0
+
+# entity -> (row type from models.py, query returning its columns in order)
+_QUERIES = {
+    'medication': (Medication, "SELECT Medicine_ID, Medicine_Name, Dosage, Price FROM medications"),
+    'department': (Department, "SELECT Dept_ID, Department_Name, Location FROM departments"),
+    'doctor': (Doctor, """
+        SELECT
+        d.Doctor_ID,
+        CONCAT(d.First_Name, " ", d.Last_Name) AS Doctor_Name,
+        d.Phone_Number,
+        d.Email,
+        d.Dept_ID,
+        dept.Department_Name
+        FROM
+            doctors AS d
+        INNER JOIN
+            departments AS dept ON d.Dept_ID = dept.Dept_ID
+    """),
+}
+
+# entity -> (row key, column used to reload single rows)
+_KEYS = {
+    'medication': ('medicine_id', 'Medicine_ID'),
+    'department': ('dept_id', 'Dept_ID'),
+    'doctor': ('doctor_id', 'd.Doctor_ID'),
+}
+
+# Doctor rows carry Department_Name, so a department change also refreshes
+# the doctors in it.
+_DEPENDENTS = {
+    'department': [('doctor', 'dept_id', 'd.Dept_ID')],
+}
+
+_lock = threading.Lock()
+_listeners = []
+_rows = {}
+_version = None
+_last_poll = 0.0
+
+def _fetch(entity, column=None, ids=None):
+    row_type, sql = _QUERIES[entity]
+    args = None
+    if column is not None:
+        sql += " WHERE %s IN (%s)" % (column, ", ".join(["%s"] * len(ids)))
+        args = list(ids)
+    # Reference data is copied to every site; read it from the home one.
+    # Like the version poll, this reads the primary: a lagging replica could
+    # hand back rows older than the version that made us fetch them.
+    with shards.use(shards.home()), routing.primary():
+        connection = db.get_connection()
+    try:
+        with db.tuple_cursor(connection) as cursor:
+            cursor.execute(sql, args)
+            return fetch_all(cursor, row_type)
+    finally:
+        connection.close()
+
+def _load(entity):
+    key = _KEYS[entity][0]
+    _rows[entity] = {getattr(row, key): row for row in _fetch(entity)}
+
+def _refresh(entity, field, column, ids):
+    rows = _rows[entity]
+    key = _KEYS[entity][0]
+    for row_id in [k for k, row in rows.items() if getattr(row, field) in ids]:
+        del rows[row_id]
+    for row in _fetch(entity, column, ids):
+        rows[getattr(row, key)] = row
+
+def _poll():
+    global _version, _last_poll
+    _last_poll = time.monotonic()
+    changed = {}
+    for change in db.get_changes_since(_version):
+        changed.setdefault(change['Entity'], set()).add(change['Entity_ID'])
+        # Each site numbers its own changes (see shards.py).
+        _version[change['Site']] = max(_version.get(change['Site'], 0), change['Version'])
+    for entity, ids in changed.items():
+        if entity in _rows:
+            key, column = _KEYS[entity]
+            _refresh(entity, key, column, ids)
+        for dependent, field, column in _DEPENDENTS.get(entity, []):
+            if dependent in _rows:
+                _refresh(dependent, field, column, ids)
+    if changed:
+        for listener in _listeners:
+            listener(changed)
+
+def _sync():
+    global _version, _last_poll
+    if _version is None:
+        # Take the version before any table is loaded so that writes racing
+        # with the first load are picked up by the next poll.
+        _version = db.get_current_version()
+        _last_poll = time.monotonic()
+    elif time.monotonic() - _last_poll >= POLL_INTERVAL:
+        _poll()
+
+def subscribe(listener):
+    # listener(changed) is called with {entity: set of ids} after each poll
+    # that saw changes, while the cache lock is held.
+    _listeners.append(listener)
+
+def sync():
+    with _lock:
+        _sync()
+
+def get_all(entity):
+    with _lock:
+        _sync()
+        if entity not in _rows:
+            _load(entity)
+        rows = _rows[entity]
+        return [rows[k] for k in sorted(rows)]
+
+def get(entity, entity_id):
+    with _lock:
+        _sync()
+        if entity not in _rows:
+            _load(entity)
+        return _rows[entity].get(entity_id)
+
+def expire():
+    # Poll on the next read, e.g. right after this process wrote something.
+    global _last_poll
+    with _lock:
+        _last_poll = 0.0
@@ -1,25 +1,132 @@
-import pymysql
-import bcrypt
+import os
+from datetime import datetime, timedelta
+
+import audit
+import dedup
+import notes
+import resilience
+import routing
+import shards
+from resilience import db_call, DatabaseUnavailable
+from routing import read_call, primary_call
+from shards import routed, placed, scatter, broadcast
+from models import (
+    Patient, Appointment, MedicalRecord, Prescription, Bill, RecordMedicine, fetch_all
+)
+
+DB_CONFIG = {
+    'host': os.environ.get('HMS_DB_HOST', 'localhost'),
+    'port': int(os.environ.get('HMS_DB_PORT', 3306)),
+    'user': os.environ.get('HMS_DB_USER', 'root'),
+    'password': os.environ.get('HMS_DB_PASSWORD', 'Ajwin2008'),
+    'database': os.environ.get('HMS_DB_NAME', 'hdb'),
+}
 
 def get_connection():
-    return pymysql.connect(
-        host='localhost',
-        user='root',
-        password='Ajwin2008',
-        database='hdb',
-        cursorclass=pymysql.cursors.DictCursor
-    )
+    import pymysql
+    import pymysql.cursors
+
+    # Connects to the current site (see shards.py); functions marked
+    # @read_call may be served by one of its replicas (see routing.py).
+    shard = shards.current()
+    return routing.connect(shard['config'], lambda config: pymysql.connect(
+        cursorclass=pymysql.cursors.DictCursor,
+        **config,
+        **resilience.connect_kwargs()
+    ), shard['replicas'])
+
+shards.configure(DB_CONFIG, routing.REPLICAS)
+
+# How @scatter merges per-site results.
+def _merge_versions(results):
+    versions = {}
+    for result in results:
+        versions.update(result)
+    return versions
+
+def _first_match(results):
+    return next((result for result in results if result), None)
+
+def _sum_occupancy(results):
+    totals = {}
+    for rows in results:
+        for row in rows:
+            key = (row['Dept_ID'], row['Slot'])
+            totals[key] = totals.get(key, 0) + row['Booked']
+    return [{'Dept_ID': dept, 'Slot': slot, 'Booked': booked} for (dept, slot), booked in totals.items()]
+
+def bump_version(cursor, entity, entity_id):
+    # Must run inside the caller's transaction. The single Change_Sequence row
+    # stays locked until commit, so versions become visible in increasing order
+    # and a poller never skips a change that commits late.
+    cursor.execute("UPDATE Change_Sequence SET Last_Version = LAST_INSERT_ID(Last_Version + 1) WHERE Seq_ID = 1")
+    if not cursor.rowcount:
+        # Without the seed row LAST_INSERT_ID() would be the last generated ID.
+        raise RuntimeError("Change_Sequence has no row 1; run migrations/026_change_versions.sql.")
+    cursor.execute("""
+        INSERT INTO Entity_Versions (Entity, Entity_ID, Version)
+        VALUES (%s, %s, LAST_INSERT_ID())
+        ON DUPLICATE KEY UPDATE Version = LAST_INSERT_ID()
+    """, (entity, entity_id))
+
+def tuple_cursor(connection):
+    # Plain tuple rows, turned into the row types in models.py.
+    import pymysql.cursors
+
+    return connection.cursor(pymysql.cursors.Cursor)
+
+@db_call
+@primary_call
+@scatter(_merge_versions)
+def get_current_version():
+    # Every site has its own sequence, so versions are {site: version}.
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT Last_Version FROM Change_Sequence WHERE Seq_ID = 1")
+            row = cursor.fetchone()
+            return {shards.current()['site']: row['Last_Version'] if row else 0}
+    finally:
+        connection.close()
+
+@db_call
+@primary_call
+@scatter()
+def get_changes_since(versions):
+    # Read on the primary: cache.py and names.py refetch the changed rows
+    # there too, and both must see at least these versions.
+    site = shards.current()['site']
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = """
+                SELECT %s AS Site, Entity, Entity_ID, Version
+                FROM Entity_Versions
+                WHERE Version > %s
+                ORDER BY Version
+            """
+            cursor.execute(sql, (site, versions.get(site, 0)))
+            return cursor.fetchall()
+    finally:
+        connection.close()
 
 def hash_password(password):
+    import bcrypt
+
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
 
 def verify_password(password, hashed_password):
+    import bcrypt
+
     return bcrypt.checkpw(password.encode(), hashed_password)
 
+@db_call
+@primary_call
+@scatter(_first_match)
 def verify_user(email, password):
-    connection = get_connection()
     if email == "Admin" and password == "Admin":
         return "admin", 0
+    connection = get_connection()
     try:
         with connection.cursor() as cursor:
             query = "SELECT password, role, user_id FROM Users WHERE username = %s"
@@ -32,6 +139,8 @@ def verify_user(email, password):
     finally:
         connection.close()
 
+@db_call
+@broadcast()
 def delete_user(email):
     connection = get_connection()
     try:
@@ -43,50 +152,256 @@ def delete_user(email):
     finally:
         connection.close()
 
-def create_apt(data):
-    connection = get_connection()
+def adjust_load(cursor, doctor_id, date, time, delta):
+    # Keeps Occupancy_Hourly (hourly grain per department and doctor) in step
+    # with this site's appointments. The doctor's daily load is counted with
+    # the slot claims on the home site (see claim_slot).
+    sql_hourly = """
+        INSERT INTO Occupancy_Hourly (Slot_Date, Dept_ID, Slot_Hour, Doctor_ID, Booked)
+        SELECT %s, Dept_ID, HOUR(%s), Doctor_ID, GREATEST(%s, 0)
+        FROM doctors
+        WHERE Doctor_ID = %s
+        ON DUPLICATE KEY UPDATE Booked = GREATEST(Occupancy_Hourly.Booked + %s, 0)
+    """
+    cursor.execute(sql_hourly, (date, time, delta, doctor_id, delta))
+
+# Doctors are copied to every site, but an appointment lives on its patient's
+# site, so a key on Appointments alone cannot stop two sites booking the same
+# doctor. Every booking first claims the slot in Doctor_Slots on the home
+# site, where the loser of a race gets duplicate-key error 1062, and the home
+# site's Doctor_Daily_Load counts those claims across all sites. On the home
+# site the claim shares the appointment's transaction; elsewhere it commits
+# first and is given back if the appointment is not written. rollups.py
+# rebuilds claims and loads from the appointments.
+_DUPLICATE = 1062
+
+class SlotTaken(Exception):
+    pass
+
+def _is_duplicate(e):
+    import pymysql
+
+    return isinstance(e, pymysql.err.IntegrityError) and e.args[0] == _DUPLICATE
+
+def _as_time(value):
+    # pymysql returns TIME columns as timedelta.
+    if isinstance(value, timedelta):
+        return (datetime.min + value).time()
+    return value
+
+def _adjust_daily_load(cursor, doctor_id, date, delta):
+    sql = """
+        INSERT INTO Doctor_Daily_Load (Doctor_ID, Load_Date, Booked)
+        VALUES (%s, %s, GREATEST(%s, 0))
+        ON DUPLICATE KEY UPDATE Booked = GREATEST(Booked + %s, 0)
+    """
+    cursor.execute(sql, (doctor_id, date, delta, delta))
+
+def claim_slot(cursor, doctor_id, date, time):
+    # Home site only. Raises the 1062 IntegrityError when the slot is taken.
+    cursor.execute(
+        "INSERT INTO Doctor_Slots (Doctor_ID, Slot_Date, Slot_Time) VALUES (%s, %s, %s)",
+        (doctor_id, date, time)
+    )
+    _adjust_daily_load(cursor, doctor_id, date, 1)
+
+def release_slot(cursor, doctor_id, date, time):
+    cursor.execute(
+        "DELETE FROM Doctor_Slots WHERE Doctor_ID = %s AND Slot_Date = %s AND Slot_Time = %s",
+        (doctor_id, date, time)
+    )
+    if cursor.rowcount:
+        _adjust_daily_load(cursor, doctor_id, date, -1)
+
+def _release_slots(cursor, slots):
+    for doctor_id, date, time in slots:
+        release_slot(cursor, doctor_id, date, time)
+
+def _on_home(cursor, fn, *args):
+    # fn(home_cursor, *args) on the home site: in the caller's transaction
+    # when the caller is on the home site, otherwise in one of its own.
+    if shards.current() is shards.home():
+        return fn(cursor, *args)
+    with shards.use(shards.home()):
+        connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = """
-                INSERT INTO appointments (Patient_ID, Doctor_ID, Appointment_Date, Appointment_Time)
-                VALUES (%s, %s, %s, %s)
-            """
-            cursor.execute(sql, (data['patient_id'], data['doctor_id'], data['date'], data['time']))
-            connection.commit()
-            print("Appointment created successfully.")
+        with connection.cursor() as home_cursor:
+            result = fn(home_cursor, *args)
+        connection.commit()
+        return result
     finally:
         connection.close()
 
-def update_aptdate(date, apt_id):
+def _claim(connection, cursor, doctor_id, date, time, message):
+    try:
+        _on_home(cursor, claim_slot, doctor_id, date, time)
+    except Exception as e:
+        if not _is_duplicate(e):
+            raise
+        connection.rollback()
+        raise SlotTaken(message)
+
+def _undo_claim(doctor_id, date, time):
+    # The appointment change failed and was rolled back. A claim made in the
+    # same transaction went with it; one committed on the home site
+    # separately is given back here.
+    if shards.current() is shards.home():
+        return
+    try:
+        _on_home(None, release_slot, doctor_id, date, time)
+    except Exception as e:
+        print(f"Could not release slot of doctor {doctor_id} on {date} {time}: {str(e)}")
+
+def _commit_releasing(connection, cursor, slots):
+    # Commits an appointment change that gave up `slots` [(doctor, date,
+    # time)]. Off the home site they are released after the commit; if that
+    # fails they stay claimed until rollups.py rebuilds the claims.
+    on_home = shards.current() is shards.home()
+    if on_home:
+        _release_slots(cursor, slots)
+    connection.commit()
+    if slots and not on_home:
+        try:
+            _on_home(None, _release_slots, slots)
+        except Exception as e:
+            print(f"Could not release {len(slots)} slots on the home site: {str(e)}")
+
+def pick_doctor(cursor, dept_id, first_date, window_days, time):
+    # Runs on the home site. Reads one Doctor_Daily_Load entry per doctor in
+    # the department per day of the window instead of counting appointments
+    # on every site. The slot check takes no lock; create_apt relies on the
+    # Doctor_Slots key and picks again when another booking got there first.
+    sql = """
+        SELECT d.Doctor_ID, COALESCE(l.Booked, 0) AS Booked
+        FROM doctors AS d
+        LEFT JOIN Doctor_Daily_Load AS l
+            ON l.Doctor_ID = d.Doctor_ID AND l.Load_Date = %s
+        WHERE d.Dept_ID = %s
+        AND NOT EXISTS (
+            SELECT 1 FROM Doctor_Slots AS s
+            WHERE s.Doctor_ID = d.Doctor_ID
+            AND s.Slot_Date = %s
+            AND s.Slot_Time = %s
+        )
+        ORDER BY Booked, d.Doctor_ID
+        LIMIT 1
+    """
+    best = None
+    for offset in range(max(window_days, 1)):
+        date = first_date + timedelta(days=offset)
+        cursor.execute(sql, (date, dept_id, date, time))
+        row = cursor.fetchone()
+        if row and (best is None or row['Booked'] < best[2]):
+            best = (row['Doctor_ID'], date, row['Booked'])
+    if best is None:
+        return None, None
+    return best[0], best[1]
+
+@db_call
+@routed('data', 'patient_id')
+def create_apt(data):
+    # With no doctor_id, a doctor from data['dept_id'] is assigned. Returns
+    # (doctor_id, date), or None when no doctor is free; raises SlotTaken when
+    # the chosen doctor already has that slot.
+    auto_assign = not data.get('doctor_id')
+    if auto_assign and data.get('dept_id') is None:
+        raise ValueError("A doctor or a department is required.")
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = """
-                UPDATE appointments
-                SET Appointment_Date = %s
-                WHERE Appointment_ID = %s
-            """
-            cursor.execute(sql, (date,  apt_id))
-            connection.commit()
-            print("Appointment updated successfully.")
+        for attempt in range(3):
+            with connection.cursor() as cursor:
+                doctor_id = data.get('doctor_id')
+                date = data['date']
+                if auto_assign:
+                    doctor_id, date = _on_home(cursor, pick_doctor, data['dept_id'], data['date'], data.get('window_days', 1), data['time'])
+                    if doctor_id is None:
+                        print("No doctor available in this department.")
+                        return None
+                try:
+                    _claim(connection, cursor, doctor_id, date, data['time'],
+                           f"Doctor {doctor_id} already has an appointment at that time.")
+                except SlotTaken:
+                    if not auto_assign:
+                        raise
+                    continue
+                sql = """
+                    INSERT INTO appointments (Patient_ID, Doctor_ID, Appointment_Date, Appointment_Time)
+                    VALUES (%s, %s, %s, %s)
+                """
+                try:
+                    cursor.execute(sql, (data['patient_id'], doctor_id, date, data['time']))
+                    adjust_load(cursor, doctor_id, date, data['time'], 1)
+                    connection.commit()
+                except Exception as e:
+                    connection.rollback()
+                    _undo_claim(doctor_id, date, data['time'])
+                    if _is_duplicate(e):
+                        raise SlotTaken(f"Doctor {doctor_id} already has an appointment at that time.")
+                    raise
+                print("Appointment created successfully.")
+                return doctor_id, date
+        print("No doctor available in this department.")
+        return None
     finally:
         connection.close()
 
-def update_apttime(time, apt_id):
+def get_apt_for_update(cursor, apt_id):
+    sql = "SELECT * FROM appointments WHERE Appointment_ID = %s FOR UPDATE"
+    cursor.execute(sql, (apt_id,))
+    return cursor.fetchone()
+
+def _move_apt(apt_id, date=None, time=None):
+    # Claims the new slot before the old one is given up.
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
+            apt = get_apt_for_update(cursor, apt_id)
+            if apt is None:
+                connection.rollback()
+                print("Appointment not found.")
+                return
+            doctor_id = apt['Doctor_ID']
+            old_date, old_time = apt['Appointment_Date'], apt['Appointment_Time']
+            new_date = old_date if date is None else date
+            new_time = old_time if time is None else time
+            moved = (new_date, _as_time(new_time)) != (old_date, _as_time(old_time))
+            if moved:
+                _claim(connection, cursor, doctor_id, new_date, new_time,
+                       "The doctor already has an appointment at that time.")
             sql = """
                 UPDATE appointments
-                SET Appointment_Time = %s
+                SET Appointment_Date = %s, Appointment_Time = %s
                 WHERE Appointment_ID = %s
             """
-            cursor.execute(sql, (time,  apt_id))
-            connection.commit()
+            try:
+                cursor.execute(sql, (new_date, new_time, apt_id))
+                if moved:
+                    adjust_load(cursor, doctor_id, old_date, old_time, -1)
+                    adjust_load(cursor, doctor_id, new_date, new_time, 1)
+                _commit_releasing(connection, cursor, [(doctor_id, old_date, old_time)] if moved else [])
+            except Exception as e:
+                connection.rollback()
+                if moved:
+                    _undo_claim(doctor_id, new_date, new_time)
+                if _is_duplicate(e):
+                    raise SlotTaken("The doctor already has an appointment at that time.")
+                raise
             print("Appointment updated successfully.")
     finally:
         connection.close()
 
+@db_call
+@routed('apt_id')
+def update_aptdate(date, apt_id):
+    _move_apt(apt_id, date=date)
+
+@db_call
+@routed('apt_id')
+def update_apttime(time, apt_id):
+    _move_apt(apt_id, time=time)
+
+@db_call
+@routed('apt_id')
 def update_aptstatus(status, apt_id):
     connection = get_connection()
     try:
@@ -102,6 +417,8 @@ def update_aptstatus(status, apt_id):
     finally:
         connection.close()
 
+@db_call
+@routed('apt_id')
 def delete_apt(apt_id):
     connection = get_connection()
     try:
@@ -110,12 +427,19 @@ def delete_apt(apt_id):
                 DELETE FROM appointments
                 WHERE Appointment_ID = %s
             """
+            apt = get_apt_for_update(cursor, apt_id)
             cursor.execute(sql, (apt_id))
-            connection.commit()
+            slots = []
+            if apt:
+                adjust_load(cursor, apt['Doctor_ID'], apt['Appointment_Date'], apt['Appointment_Time'], -1)
+                slots.append((apt['Doctor_ID'], apt['Appointment_Date'], apt['Appointment_Time']))
+            _commit_releasing(connection, cursor, slots)
             print("Appointment deleted successfully.")
     finally:
         connection.close()
 
+@db_call
+@routed('data', 'patient_id')
 def create_bill(data):
     connection = get_connection()
     try:
@@ -127,31 +451,38 @@ def create_bill(data):
     finally:
         connection.close()
 
+@db_call
+@read_call
+@scatter()
 def get_all_bills():
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = "SELECT * FROM Bills"
+        with tuple_cursor(connection) as cursor:
+            sql = "SELECT Bill_ID, Patient_ID, Bill_Date, Payment_Status, Amount FROM Bills"
             cursor.execute(sql)
-            bills = cursor.fetchall()
+            bills = fetch_all(cursor, Bill)
             return bills
     finally:
         connection.close()
 
+@db_call
+@read_call
+@routed('data')
 def get_bills(data):
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = "SELECT * FROM Bills WHERE Patient_ID = %s"
+        with tuple_cursor(connection) as cursor:
+            sql = "SELECT Bill_ID, Patient_ID, Bill_Date, Payment_Status, Amount FROM Bills WHERE Patient_ID = %s"
             cursor.execute(sql, (data,))
-            bill = cursor.fetchone()
-            if not bill:
+            bills = fetch_all(cursor, Bill)
+            if not bills:
                 print("Bill not found.")
-            else:
-                print(bill)
+            return bills
     finally:
         connection.close()
 
+@db_call
+@routed('bill_id')
 def update_amount(bill_id, amount):
     connection = get_connection()
     try:
@@ -163,6 +494,8 @@ def update_amount(bill_id, amount):
     finally:
         connection.close()
 
+@db_call
+@routed('bill_id')
 def update_status(bill_id, status):
     connection = get_connection()
     try:
@@ -174,10 +507,13 @@ def update_status(bill_id, status):
     finally:
         connection.close()
 
+@db_call
+@read_call
+@routed('total_patient_id')
 def get_totals(total_patient_id):
     conn = get_connection()
     try:
-        with conn.cursor() as cursor:
+        with tuple_cursor(conn) as cursor:
             sql = """
                 SELECT SUM(Amount) AS Total
                 FROM bills
@@ -197,88 +533,244 @@ def get_totals(total_patient_id):
         conn.close()
 
 
-def get_medicines():
-    conn = get_connection()
-    try:
-        with conn.cursor() as cursor:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM medications')
-            medicines = cursor.fetchall()
-            return medicines
-    finally:
-        conn.close()
-
+@db_call
+@broadcast('medicine_id')
 def add_medicine(data):
     conn = get_connection()
     cursor = conn.cursor()
-    sql = "INSERT INTO medications (medicine_name, dosage, price) VALUES (%s, %s, %s)"
-    cursor.execute(sql, (data['name'],data['dosage'],data['price']))
+    if data.get('medicine_id'):
+        sql = "INSERT INTO medications (medicine_id, medicine_name, dosage, price) VALUES (%s, %s, %s, %s)"
+        cursor.execute(sql, (data['medicine_id'],data['name'],data['dosage'],data['price']))
+    else:
+        sql = "INSERT INTO medications (medicine_name, dosage, price) VALUES (%s, %s, %s)"
+        cursor.execute(sql, (data['name'],data['dosage'],data['price']))
+    medicine_id = data.get('medicine_id') or cursor.lastrowid
+    bump_version(cursor, 'medication', medicine_id)
     conn.commit()
     conn.close()
+    return medicine_id
 
+@db_call
+@broadcast()
 def update_price(med_id, new_price):
     conn = get_connection()
     cursor = conn.cursor()
     sql = "UPDATE medications SET price = %s WHERE medicine_id = %s"
     cursor.execute(sql, (new_price, med_id))
+    bump_version(cursor, 'medication', med_id)
     conn.commit()
     conn.close()
 
+@db_call
+@broadcast()
 def delete_medicine(med_id):
     conn = get_connection()
     cursor = conn.cursor()
     sql = "DELETE FROM medications WHERE medicine_id = %s"
     cursor.execute(sql, med_id)
+    bump_version(cursor, 'medication', med_id)
     conn.commit()
     conn.close()
 
+@db_call
+@broadcast()
 def update_dosage(med_id, new_dosage):
     conn = get_connection()
     cursor = conn.cursor()
     sql = "UPDATE medications SET dosage = %s WHERE medicine_id = %s"
     cursor.execute(sql, (new_dosage, med_id))
+    bump_version(cursor, 'medication', med_id)
     conn.commit()
     conn.close()
 
-def create_prescription(data):
+# Pharmacy stock, kept per site. Each medicine's count is split over
+# STOCK_STRIPES rows of Medication_Stock so concurrent prescriptions of the
+# same drug usually lock different rows. A medicine with no stock rows is not
+# tracked and is never refused.
+STOCK_STRIPES = int(os.environ.get('HMS_STOCK_STRIPES', 8))
+_STOCK_TRIES = 2
+_DEADLOCK = 1213
+
+class OutOfStock(Exception):
+    def __init__(self, medicine_id, requested, available):
+        super().__init__(f"Only {available} of medicine {medicine_id} in stock, {requested} requested.")
+        self.medicine_id = medicine_id
+        self.requested = requested
+        self.available = available
+
+def take_stock(cursor, items):
+    # items maps medicine ID -> quantity. Must run inside the caller's
+    # transaction, as late as possible, since the stripes stay locked until
+    # commit. Medicines are taken in ID order so batches cannot deadlock on
+    # each other's medicines.
+    import random
+
+    for medicine_id, quantity in sorted(items.items()):
+        if quantity <= 0:
+            continue
+        # Untracked medicines are found with a plain (non-locking) read: a
+        # locking read or update of rows that do not exist would gap-lock
+        # the key range and block restocks and other medicines near it.
+        cursor.execute("SELECT 1 FROM Medication_Stock WHERE Medicine_ID = %s LIMIT 1", (medicine_id,))
+        if not cursor.fetchone():
+            continue
+        # Fast path: one conditional decrement on a random stripe, then its
+        # neighbour; no other stripe is touched.
+        first = random.randrange(STOCK_STRIPES)
+        taken = False
+        for i in range(min(_STOCK_TRIES, STOCK_STRIPES)):
+            cursor.execute(
+                "UPDATE Medication_Stock SET Quantity = Quantity - %s WHERE Medicine_ID = %s AND Slot = %s AND Quantity >= %s",
+                (quantity, medicine_id, (first + i) % STOCK_STRIPES, quantity)
+            )
+            if cursor.rowcount:
+                taken = True
+                break
+        if taken:
+            continue
+        # Slow path, for low or uneven stock: lock every stripe and drain
+        # them in order.
+        cursor.execute(
+            "SELECT Slot, Quantity FROM Medication_Stock WHERE Medicine_ID = %s ORDER BY Slot FOR UPDATE",
+            (medicine_id,)
+        )
+        stripes = cursor.fetchall()
+        available = sum(row['Quantity'] for row in stripes)
+        if available < quantity:
+            raise OutOfStock(medicine_id, quantity, available)
+        left = quantity
+        for row in stripes:
+            take = min(left, row['Quantity'])
+            if take:
+                cursor.execute(
+                    "UPDATE Medication_Stock SET Quantity = Quantity - %s WHERE Medicine_ID = %s AND Slot = %s",
+                    (take, medicine_id, row['Slot'])
+                )
+                left -= take
+            if not left:
+                break
+
+@db_call
+def restock(items, site=None):
+    # Batch restock: items maps medicine ID -> quantity received, spread
+    # evenly over the stripes in one statement.
+    rows = []
+    for medicine_id, quantity in items.items():
+        share, extra = divmod(int(quantity), STOCK_STRIPES)
+        for slot in range(STOCK_STRIPES):
+            rows.append((medicine_id, slot, share + (1 if slot < extra else 0)))
+    with shards.use(shards.shard_for_site(site) if site else shards.current()):
+        connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = """
+                INSERT INTO Medication_Stock (Medicine_ID, Slot, Quantity) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE Quantity = Quantity + VALUES(Quantity)
+            """
+            cursor.executemany(sql, rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+@db_call
+def set_reorder_level(medicine_id, level, site=None):
+    with shards.use(shards.shard_for_site(site) if site else shards.current()):
+        connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = """
+                INSERT INTO Medication_Reorder_Levels (Medicine_ID, Reorder_Level) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE Reorder_Level = VALUES(Reorder_Level)
+            """
+            cursor.execute(sql, (medicine_id, level))
+        connection.commit()
+    finally:
+        connection.close()
+
+@db_call
+@read_call
+@scatter()
+def get_stock(low_only=False):
+    # Stock per site and medicine, with its reorder level; low_only keeps the
+    # medicines at or below their level.
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
-            sql = "INSERT INTO prescriptions (Record_ID, Medicine_ID, Quantity, Start_Date, End_Date) VALUES (%s, %s, %s, %s, %s)"
-            sql2= "INSERT INTO prescription_frequencies (prescription_ID, frequency) VALUES (%s, %s)"
-            cursor.execute(sql, (data['record_id'],data['medicine_id'],data['quantity'], data['start_date'],data['end_date']))
-            cursor.execute(sql2, (data['record_id'],data['frequency']))
-            connection.commit()
-            print("Prescription created successfully.")
+            sql = """
+                SELECT %s AS Site, s.Medicine_ID, SUM(s.Quantity) AS Quantity, r.Reorder_Level
+                FROM Medication_Stock AS s
+                LEFT JOIN Medication_Reorder_Levels AS r ON r.Medicine_ID = s.Medicine_ID
+                GROUP BY s.Medicine_ID, r.Reorder_Level
+            """
+            if low_only:
+                sql += " HAVING SUM(s.Quantity) <= r.Reorder_Level"
+            cursor.execute(sql, (shards.current()['site'],))
+            return cursor.fetchall()
     finally:
         connection.close()
 
+@db_call
+@routed('data', 'record_id')
+def create_prescription(data):
+    import pymysql
+
+    connection = get_connection()
+    try:
+        # Retried on deadlock: two prescriptions that both fall back to the
+        # slow path of take_stock can lock each other's stripes.
+        for attempt in range(3):
+            try:
+                with connection.cursor() as cursor:
+                    sql = "INSERT INTO prescriptions (Record_ID, Medicine_ID, Quantity, Start_Date, End_Date) VALUES (%s, %s, %s, %s, %s)"
+                    sql2= "INSERT INTO prescription_frequencies (prescription_ID, frequency) VALUES (%s, %s)"
+                    cursor.execute(sql, (data['record_id'],data['medicine_id'],data['quantity'], data['start_date'],data['end_date']))
+                    cursor.execute(sql2, (data['record_id'],data['frequency']))
+                    take_stock(cursor, {data['medicine_id']: data['quantity']})
+                connection.commit()
+                break
+            except OutOfStock:
+                connection.rollback()
+                raise
+            except pymysql.err.OperationalError as e:
+                connection.rollback()
+                if e.args[0] != _DEADLOCK or attempt == 2:
+                    raise
+        print("Prescription created successfully.")
+    finally:
+        connection.close()
+
+@db_call
+@read_call
+@scatter()
 def get_all_prescriptions():
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = "SELECT * FROM Prescriptions"
+        with tuple_cursor(connection) as cursor:
+            sql = "SELECT Prescription_ID, Record_ID, Medicine_ID, Quantity, Start_Date, End_Date FROM Prescriptions"
             cursor.execute(sql)
-            prescriptions = cursor.fetchall()
+            prescriptions = fetch_all(cursor, Prescription)
             if not prescriptions:
                 print("No prescriptions found.")
-            else:
-                for prescription in prescriptions:
-                    print(prescription)
+            return prescriptions
     finally:
         connection.close()
 
+@db_call
+@read_call
+@routed('record')
 def get_prescription(record, medicine):
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = "SELECT * FROM Prescriptions WHERE Record_ID = %s AND Medicine_ID = %s"
+        with tuple_cursor(connection) as cursor:
+            sql = "SELECT Prescription_ID, Record_ID, Medicine_ID, Quantity, Start_Date, End_Date FROM Prescriptions WHERE Record_ID = %s AND Medicine_ID = %s"
             cursor.execute(sql, (record, medicine))
-            prescription = cursor.fetchall()
+            prescription = fetch_all(cursor, Prescription)
             return prescription
     finally:
         connection.close()
 
+@db_call
+@routed('record_id')
 def update_quantity(record_id, medicine_id, quantity):
     connection = get_connection()
     try:
@@ -294,6 +786,8 @@ def update_quantity(record_id, medicine_id, quantity):
     finally:
         connection.close()
 
+@db_call
+@routed('record_id')
 def update_end_date(record_id, medicine_id, end_date):
     connection = get_connection()
     try:
@@ -309,6 +803,8 @@ def update_end_date(record_id, medicine_id, end_date):
     finally:
         connection.close()
 
+@db_call
+@routed('record_id')
 def update_frequency(record_id, new_frequency):
     conn = get_connection()
     cursor = conn.cursor()
@@ -317,45 +813,98 @@ def update_frequency(record_id, new_frequency):
     conn.commit()
     conn.close()
 
+@db_call
+@routed('data', 'patient_id')
 def create_record(data):
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
             sql = """
-                INSERT INTO medical_record (Patient_ID, Doctor_ID, Record_Date, Diagnosis, Treatment)
+                INSERT INTO medical_record (Patient_ID, Doctor_ID, Record_Date, Diagnosis_Summary, Treatment_Summary)
                 VALUES (%s, %s, %s, %s, %s)
             """
             cursor.execute(sql, (
                 data['patient_id'], data['doctor_id'], data['date'],
-                data['diagnosis'], data['treatment']
+                notes.summary(data['diagnosis']), notes.summary(data['treatment'])
             ))
+            record_id = cursor.lastrowid
+            rows = [(record_id, field, notes.pack(data[field])) for field in notes.FIELDS if data[field] is not None]
+            if rows:
+                cursor.executemany("INSERT INTO Clinical_Notes (Record_ID, Field, Body) VALUES (%s, %s, %s)", rows)
             connection.commit()
             print("Record created successfully.")
+            return record_id
     finally:
         connection.close()
 
-def update_diagnosis(record_id, diagnosis):
+def write_note(cursor, record_id, field, text):
+    # Summary and compressed body change together, in the caller's transaction.
+    # Returns False, writing nothing, when there is no such record.
+    cursor.execute("SELECT Record_ID FROM medical_record WHERE Record_ID = %s FOR UPDATE", (record_id,))
+    if not cursor.fetchone():
+        return False
+    cursor.execute(
+        "UPDATE medical_record SET %s_Summary = %%s WHERE Record_ID = %%s" % field.capitalize(),
+        (notes.summary(text), record_id)
+    )
+    cursor.execute("""
+        INSERT INTO Clinical_Notes (Record_ID, Field, Body) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE Body = VALUES(Body)
+    """, (record_id, field, notes.pack(text)))
+    return True
+
+@db_call
+@routed('record_id')
+def update_diagnosis(record_id, diagnosis, actor=None):
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
-            sql = "UPDATE medical_record SET Diagnosis = %s WHERE Record_ID = %s"
-            cursor.execute(sql, (diagnosis, record_id))
+            if not write_note(cursor, record_id, 'diagnosis', diagnosis):
+                connection.rollback()
+                print("Medical record not found.")
+                return False
             connection.commit()
+            audit.log('update_diagnosis', actor, record_id=record_id)
             print("Diagnosis updated successfully.")
+            return True
     finally:
         connection.close()
 
-def update_treatment(record_id, treatment):
+@db_call
+@routed('record_id')
+def update_treatment(record_id, treatment, actor=None):
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
-            sql = "UPDATE medical_record SET Treatment = %s WHERE Record_ID = %s"
-            cursor.execute(sql, (treatment, record_id))
+            if not write_note(cursor, record_id, 'treatment', treatment):
+                connection.rollback()
+                print("Medical record not found.")
+                return False
             connection.commit()
+            audit.log('update_treatment', actor, record_id=record_id)
             print("Treatment updated successfully.")
+            return True
+    finally:
+        connection.close()
+
+@db_call
+@read_call
+@routed('record_id')
+def get_record_notes(record_id, actor=None):
+    # Full diagnosis and treatment of one record, for when it is opened;
+    # listings only carry the summaries.
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT Field, Body FROM Clinical_Notes WHERE Record_ID = %s", (record_id,))
+            bodies = {row['Field']: row['Body'] for row in cursor.fetchall()}
+            audit.log('view_notes', actor, record_id=record_id)
+            return {field: notes.unpack(bodies[field]) if field in bodies else None for field in notes.FIELDS}
     finally:
         connection.close()
 
+@db_call
+@placed
 def register_patient(data):
     connection = get_connection()
     try:
@@ -365,7 +914,7 @@ def register_patient(data):
             
             try:
                 # Hash password
-                hashed_password = bcrypt.hashpw(data['password'].encode(), bcrypt.gensalt())
+                hashed_password = hash_password(data['password'])
                 
                 # Insert into patients table
                 sql_patient = """
@@ -395,6 +944,8 @@ def register_patient(data):
                     VALUES (%s, %s)
                 """
                 cursor.execute(sql_phone, (patient_id, data['phone_number']))
+                dedup.add_keys(cursor, patient_id, data)
+                bump_version(cursor, 'patient', patient_id)
                 
                 # If everything is successful, commit the transaction
                 connection.commit()
@@ -410,57 +961,94 @@ def register_patient(data):
     finally:
         connection.close()
 
+@db_call
+@broadcast('doctor_id')
 def register_doctor(data):
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
-            hashed_password = bcrypt.hashpw(data['password'].encode(), bcrypt.gensalt())
+            hashed_password = hash_password(data['password'])
             sql = """
-                INSERT INTO doctors (First_Name, Last_Name, Phone_Number, Email, Dept_ID, Password)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT INTO doctors (Doctor_ID, First_Name, Last_Name, Phone_Number, Email, Dept_ID, Password)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
             """
             sql_user1 = """
                 INSERT INTO users (username, password, role)
                 VALUES (%s, %s, %s)
             """
+            # Doctor_ID is None (generated) on the home site and that ID on
+            # the others.
             cursor.execute(sql, (
-                data['first_name'], data['last_name'], data['phone_number'],
+                data.get('doctor_id'), data['first_name'], data['last_name'], data['phone_number'],
                 data['email'], data['dept_id'], hashed_password
             ))
+            doctor_id = data.get('doctor_id') or cursor.lastrowid
+            bump_version(cursor, 'doctor', doctor_id)
             cursor.execute(sql_user1, (
                 data['email'], hashed_password, "doctor"
             ))
             connection.commit()
             print("Doctor registered successfully.")
+            return doctor_id
     finally:
         connection.close()
 
+@db_call
+@routed('patient_id')
 def delete_patient(patient_id):
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
+            # The cascade removes the patient's appointments, so give up their
+            # slots and take them out of the hourly counters first.
+            sql_slots = """
+                SELECT Doctor_ID, Appointment_Date, Appointment_Time
+                FROM appointments
+                WHERE Patient_ID = %s AND Doctor_ID IS NOT NULL
+                FOR UPDATE
+            """
+            cursor.execute(sql_slots, (patient_id,))
+            slots = [(row['Doctor_ID'], row['Appointment_Date'], row['Appointment_Time']) for row in cursor.fetchall()]
+            sql_hourly = """
+                UPDATE Occupancy_Hourly AS o
+                INNER JOIN (
+                    SELECT Doctor_ID, Appointment_Date, HOUR(Appointment_Time) AS Slot_Hour, COUNT(*) AS Booked
+                    FROM appointments
+                    WHERE Patient_ID = %s
+                    GROUP BY Doctor_ID, Appointment_Date, HOUR(Appointment_Time)
+                ) AS a ON a.Doctor_ID = o.Doctor_ID AND a.Appointment_Date = o.Slot_Date AND a.Slot_Hour = o.Slot_Hour
+                SET o.Booked = GREATEST(o.Booked - a.Booked, 0)
+            """
+            cursor.execute(sql_hourly, (patient_id,))
             sql = "DELETE FROM patients WHERE patient_id = %s"
             cursor.execute(sql, (patient_id,))
-            connection.commit()
+            bump_version(cursor, 'patient', patient_id)
+            _commit_releasing(connection, cursor, slots)
         print("Patient deleted successfully.")
     finally:
         connection.close()
 
+@db_call
+@broadcast()
 def delete_doctor(doctor_id):
     connection = get_connection()
     try:
         with connection.cursor() as cursor:
             sql = "DELETE FROM doctors WHERE doctor_id = %s"
             cursor.execute(sql, (doctor_id,))
+            bump_version(cursor, 'doctor', doctor_id)
             connection.commit()
         print("Doctor deleted successfully.")
     finally:
         connection.close()
 
+@db_call
+@read_call
+@scatter()
 def get_all_patients():
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
+        with tuple_cursor(connection) as cursor:
             sql = """
                 SELECT
                 p.Patient_ID,
@@ -476,126 +1064,152 @@ def get_all_patients():
                     patient_phone_numbers AS ph ON p.Patient_ID = ph.Patient_ID;
             """
             cursor.execute(sql)
-            patients = cursor.fetchall()
+            patients = fetch_all(cursor, Patient)
             print(patients)
             return patients
     finally:
         connection.close()
 
-def get_all_doctors():
-    connection = get_connection()
-    try:
-        with connection.cursor() as cursor:
-            sql = """
-                SELECT
-                d.Doctor_ID,
-                CONCAT(d.First_Name, " ", d.Last_Name) AS Doctor_Name,
-                d.Phone_Number,
-                d.Email,
-                d.Dept_ID,
-                dept.Department_Name
-                FROM
-                    doctors AS d
-                INNER JOIN
-                    departments AS dept ON d.Dept_ID = dept.Dept_ID;
-            """
-            cursor.execute(sql)
-            doctors = cursor.fetchall()
-            print(doctors)
-            return doctors
-    finally:
-        connection.close()
-
+@db_call
+@read_call
+@scatter()
 def get_all_apts():
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
+        with tuple_cursor(connection) as cursor:
+            # Names are filled in by names.enrich, not joined here.
             sql =  """
                 SELECT
                 a.appointment_id,
-                CONCAT(p.First_Name, " ", p.Last_Name) AS Patient_Name,
-                CONCAT(d.First_Name, " ", d.Last_Name) AS Doctor_Name,
-                a.appointment_time,
+                a.Patient_ID,
+                a.Doctor_ID,
                 a.appointment_date,
+                a.appointment_time,
                 a.appointment_status
                 FROM
-                    appointments AS a
-                INNER JOIN
-                    doctors AS d ON d.Doctor_ID = a.Doctor_ID
-                INNER JOIN
-                    patients AS p ON p.Patient_ID = a.Patient_ID;
+                    appointments AS a;
             """
             cursor.execute(sql)
-            apts = cursor.fetchall()
+            apts = fetch_all(cursor, Appointment)
             return apts
     finally:
         connection.close()
 
+@db_call
+@read_call
+@scatter()
 def get_all_records():
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            sql = "CALL rec_pre8();"
+        with tuple_cursor(connection) as cursor:
+            # Same rows as the rec_pre procedure, without the name joins.
+            sql = """
+                SELECT
+                mr.Record_ID,
+                mr.Patient_ID,
+                mr.Doctor_ID,
+                pr.Medicine_ID
+                FROM
+                    medical_record AS mr
+                INNER JOIN
+                    prescriptions AS pr ON pr.Record_ID = mr.Record_ID;
+            """
             cursor.execute(sql)
-            records = cursor.fetchall()
+            records = fetch_all(cursor, RecordMedicine)
             return records
     finally:
         connection.close()
 
+@db_call
+@read_call
+@scatter()
 def get_doctor_appointments(doctor_id):
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            query = "SELECT * FROM Appointments WHERE doctor_id = %s"
+        with tuple_cursor(connection) as cursor:
+            query = "SELECT Appointment_ID, Patient_ID, Doctor_ID, Appointment_Date, Appointment_Time, Appointment_Status FROM Appointments WHERE doctor_id = %s"
             cursor.execute(query, (doctor_id,))
-            appointments = cursor.fetchall()
+            appointments = fetch_all(cursor, Appointment)
             if not appointments:
                 print("No appointments found for this doctor.")
             return appointments
     finally:
         connection.close()
 
+@db_call
+@read_call
+@routed('patient_id')
 def get_patient_records_for_doctor(doctor_id, patient_id):
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
+        with tuple_cursor(connection) as cursor:
             query = """
-                SELECT * FROM Medical_Record
+                SELECT Record_ID, Patient_ID, Doctor_ID, Record_Date, Diagnosis_Summary, Treatment_Summary
+                FROM Medical_Record
                 WHERE patient_id = %s
                 AND EXISTS (
                     SELECT * FROM Doctors WHERE doctor_id = %s
                 )
             """
             cursor.execute(query, (patient_id, doctor_id))
-            records = cursor.fetchall()
+            records = fetch_all(cursor, MedicalRecord)
+            audit.log_many('view', ('doctor', doctor_id), patient_id, [r.record_id for r in records])
             if not records:
                 print("No medical records found for this patient.")
             return records
     finally:
         connection.close()
 
+@db_call
+@read_call
+@routed('patient_id')
 def get_patient_appointments(patient_id):
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            query = "SELECT * FROM Appointments WHERE patient_id = %s"
+        with tuple_cursor(connection) as cursor:
+            query = "SELECT Appointment_ID, Patient_ID, Doctor_ID, Appointment_Date, Appointment_Time, Appointment_Status FROM Appointments WHERE patient_id = %s"
             cursor.execute(query, (patient_id,))
-            appointments = cursor.fetchall()
+            appointments = fetch_all(cursor, Appointment)
             if not appointments:
                 print("No appointments found for this patient.")
             return appointments
     finally:
         connection.close()
 
-def get_medical_records(patient_id):
+@db_call
+@read_call
+@routed('patient_id')
+def get_medical_records(patient_id, actor=None):
     connection = get_connection()
     try:
-        with connection.cursor() as cursor:
-            query = "SELECT * FROM Medical_Record WHERE patient_id = %s"
+        with tuple_cursor(connection) as cursor:
+            query = "SELECT Record_ID, Patient_ID, Doctor_ID, Record_Date, Diagnosis_Summary, Treatment_Summary FROM Medical_Record WHERE patient_id = %s"
             cursor.execute(query, (patient_id,))
-            records = cursor.fetchall()
+            records = fetch_all(cursor, MedicalRecord)
+            audit.log_many('view', actor, patient_id, [r.record_id for r in records])
             if not records:
                 print("No medical records found for this patient.")
             return records
     finally:
         connection.close()
+
+@db_call
+@read_call
+@scatter(_sum_occupancy)
+def get_occupancy(start_date, end_date, grain='hour'):
+    # Reads only the rollup; grain 'hour' gives bookings per department per
+    # hour of day over the range, 'day' gives bookings per department per date.
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            column = "Slot_Hour" if grain == 'hour' else "Slot_Date"
+            sql = f"""
+                SELECT Dept_ID, {column} AS Slot, SUM(Booked) AS Booked
+                FROM Occupancy_Hourly
+                WHERE Slot_Date BETWEEN %s AND %s
+                GROUP BY Dept_ID, {column}
+            """
+            cursor.execute(sql, (start_date, end_date))
+            return cursor.fetchall()
+    finally:
+        connection.close()
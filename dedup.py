@@ -0,0 +1,284 @@
+import difflib
+import re
+
+import audit
+import db
+import resilience
+import routing
+import shards
+
+# Pairs scoring at or above this are reported as likely the same person.
+MATCH_THRESHOLD = 0.6
+# Blocks bigger than this (e.g. a shared front-desk phone number) carry no
+# signal and would bring back the quadratic blow-up, so they are skipped.
+MAX_BLOCK_SIZE = 50
+CHUNK_SIZE = 5000
+
+_SOUNDEX_CODES = {}
+for _letters, _code in (("BFPV", "1"), ("CGJKQSXZ", "2"), ("DT", "3"), ("L", "4"), ("MN", "5"), ("R", "6")):
+    for _letter in _letters:
+        _SOUNDEX_CODES[_letter] = _code
+
+def soundex(name):
+    name = re.sub(r"[^A-Z]", "", (name or "").upper())
+    if not name:
+        return ""
+    code = name[0]
+    last = _SOUNDEX_CODES.get(name[0], "")
+    for letter in name[1:]:
+        digit = _SOUNDEX_CODES.get(letter, "")
+        if digit and digit != last:
+            code += digit
+        if letter not in "HW":
+            last = digit
+    return (code + "000")[:4]
+
+def normalize_phone(phone):
+    digits = re.sub(r"\D", "", phone or "")
+    return digits[-10:]
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+def block_keys(first_name, last_name, dob, email, phones):
+    keys = set()
+    for phone in phones:
+        phone = normalize_phone(phone)
+        if len(phone) >= 7:
+            keys.add("ph:" + phone)
+    email = normalize_email(email)
+    if email:
+        keys.add("em:" + email)
+    if dob:
+        if last_name:
+            keys.add("ld:%s:%s" % (soundex(last_name), dob))
+        if first_name:
+            keys.add("fd:%s:%s" % (soundex(first_name), dob))
+    return keys
+
+def _keys_for_data(data):
+    return block_keys(data['first_name'], data['last_name'], data['dob'],
+                      data['email'], [data['phone_number']])
+
+def _keys_for_patient(patient):
+    return block_keys(patient['First_Name'], patient['Last_Name'], patient['Date_of_Birth'],
+                      patient['Email'], patient['phones'])
+
+def score(a, b):
+    total = 0.0
+    if a['Email'] and normalize_email(a['Email']) == normalize_email(b['Email']):
+        total += 0.35
+    phones_a = {normalize_phone(p) for p in a['phones']} - {""}
+    phones_b = {normalize_phone(p) for p in b['phones']} - {""}
+    if phones_a & phones_b:
+        total += 0.3
+    if a['Date_of_Birth'] and str(a['Date_of_Birth']) == str(b['Date_of_Birth']):
+        total += 0.15
+    name_a = ("%s %s" % (a['First_Name'] or "", a['Last_Name'] or "")).strip().lower()
+    name_b = ("%s %s" % (b['First_Name'] or "", b['Last_Name'] or "")).strip().lower()
+    total += 0.2 * difflib.SequenceMatcher(None, name_a, name_b).ratio()
+    return round(total, 3)
+
+def add_keys(cursor, patient_id, data):
+    # Called inside register_patient's transaction.
+    keys = _keys_for_data(data)
+    if keys:
+        sql = "INSERT IGNORE INTO Patient_Block_Keys (Block_Key, Patient_ID) VALUES (%s, %s)"
+        cursor.executemany(sql, [(key, patient_id) for key in keys])
+
+def _load_patients(cursor, where="", args=None):
+    sql = """
+        SELECT
+        p.Patient_ID,
+        p.First_Name,
+        p.Last_Name,
+        p.Date_of_Birth,
+        p.Email,
+        ph.Phone_Number
+        FROM
+            patients AS p
+        LEFT JOIN
+            patient_phone_numbers AS ph ON p.Patient_ID = ph.Patient_ID
+    """ + where
+    cursor.execute(sql, args)
+    patients = {}
+    for row in cursor.fetchall():
+        patient = patients.get(row['Patient_ID'])
+        if patient is None:
+            patient = dict(row, phones=[])
+            del patient['Phone_Number']
+            patients[row['Patient_ID']] = patient
+        if row['Phone_Number']:
+            patient['phones'].append(row['Phone_Number'])
+    return patients
+
+def _site_candidates(keys, exclude):
+    with routing.reading():
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = "SELECT DISTINCT Patient_ID FROM Patient_Block_Keys WHERE Block_Key IN (%s)" % ", ".join(["%s"] * len(keys))
+            cursor.execute(sql, keys)
+            ids = [row['Patient_ID'] for row in cursor.fetchall() if row['Patient_ID'] != exclude]
+            if not ids:
+                return {}
+            return _load_patients(cursor, "WHERE p.Patient_ID IN (%s)" % ", ".join(["%s"] * len(ids)), ids)
+    finally:
+        connection.close()
+
+def find_candidates(data, exclude=None):
+    # Only patients sharing a blocking key are fetched and scored, so this is
+    # a couple of indexed lookups per site regardless of table size.
+    keys = list(_keys_for_data(data))
+    if not keys:
+        return []
+    patients = {}
+    for found in shards.run_all(lambda: _site_candidates(keys, exclude)):
+        patients.update(found)
+    new = {
+        'First_Name': data['first_name'], 'Last_Name': data['last_name'],
+        'Date_of_Birth': data['dob'], 'Email': data['email'], 'phones': [data['phone_number']],
+    }
+    matches = []
+    for patient in patients.values():
+        s = score(new, patient)
+        if s >= MATCH_THRESHOLD:
+            matches.append(dict(patient, Score=s))
+    matches.sort(key=lambda m: m['Score'], reverse=True)
+    return matches
+
+def rebuild_keys():
+    # Backfill for patients registered before Patient_Block_Keys existed.
+    return sum(shards.run_all(_rebuild_site_keys))
+
+def _rebuild_site_keys():
+    with resilience.deadline(None):
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            patients = _load_patients(cursor)
+            cursor.execute("DELETE FROM Patient_Block_Keys")
+            rows = [(key, pid) for pid, patient in patients.items() for key in _keys_for_patient(patient)]
+            sql = "INSERT IGNORE INTO Patient_Block_Keys (Block_Key, Patient_ID) VALUES (%s, %s)"
+            for start in range(0, len(rows), CHUNK_SIZE):
+                cursor.executemany(sql, rows[start:start + CHUNK_SIZE])
+            connection.commit()
+            return len(rows)
+    finally:
+        connection.close()
+
+_worker_patients = None
+
+def _init_worker(patients):
+    global _worker_patients
+    _worker_patients = patients
+
+def _score_pairs(pairs):
+    results = []
+    for a, b in pairs:
+        s = score(_worker_patients[a], _worker_patients[b])
+        if s >= MATCH_THRESHOLD:
+            results.append((s, a, b))
+    return results
+
+def _load_site_patients():
+    with resilience.deadline(None), routing.reading():
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            return _load_patients(cursor)
+    finally:
+        connection.close()
+
+def find_all_duplicates(processes=None):
+    # Batch job over the whole patients table; returns (score, id, id) best first.
+    import multiprocessing
+
+    # Patient IDs are unique across sites (see shards.py), so the sites'
+    # patients can share one dict.
+    patients = {}
+    for site_patients in shards.run_all(_load_site_patients):
+        patients.update(site_patients)
+
+    blocks = {}
+    for pid, patient in patients.items():
+        for key in _keys_for_patient(patient):
+            blocks.setdefault(key, []).append(pid)
+    pairs = set()
+    for ids in blocks.values():
+        if 1 < len(ids) <= MAX_BLOCK_SIZE:
+            ids.sort()
+            for i, a in enumerate(ids):
+                for b in ids[i + 1:]:
+                    pairs.add((a, b))
+    pairs = sorted(pairs)
+    chunks = [pairs[i:i + CHUNK_SIZE] for i in range(0, len(pairs), CHUNK_SIZE)]
+
+    if len(chunks) <= 1:
+        _init_worker(patients)
+        results = [r for chunk in chunks for r in _score_pairs(chunk)]
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(patients,)) as pool:
+            results = [r for part in pool.imap_unordered(_score_pairs, chunks) for r in part]
+    results.sort(reverse=True)
+    return results
+
+def merge_patients(keep_id, drop_id, actor=None):
+    # Move everything owned by drop_id onto keep_id, then delete drop_id and
+    # its login. Raises ValueError if either patient does not exist.
+    if keep_id == drop_id:
+        raise ValueError("Cannot merge a patient into itself.")
+    shard = shards.shard_for_id(keep_id)
+    if shards.shard_for_id(drop_id) is not shard:
+        raise ValueError("Patients registered at different sites cannot be merged.")
+    with shards.use(shard):
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            connection.begin()
+            try:
+                # Lock both first: phones and blocking keys have no foreign
+                # key, so a mistyped keep_id would otherwise take them over.
+                cursor.execute(
+                    "SELECT Patient_ID, Email FROM patients WHERE Patient_ID IN (%s, %s) FOR UPDATE",
+                    (keep_id, drop_id)
+                )
+                emails = {row['Patient_ID']: row['Email'] for row in cursor.fetchall()}
+                for patient_id in (keep_id, drop_id):
+                    if patient_id not in emails:
+                        raise ValueError(f"Patient {patient_id} does not exist.")
+                for table in ("appointments", "medical_record", "bills"):
+                    cursor.execute("UPDATE %s SET Patient_ID = %%s WHERE Patient_ID = %%s" % table, (keep_id, drop_id))
+                cursor.execute("""
+                    INSERT IGNORE INTO patient_phone_numbers (Patient_ID, Phone_Number)
+                    SELECT %s, Phone_Number FROM patient_phone_numbers WHERE Patient_ID = %s
+                """, (keep_id, drop_id))
+                cursor.execute("DELETE FROM patient_phone_numbers WHERE Patient_ID = %s", (drop_id,))
+                cursor.execute("""
+                    INSERT IGNORE INTO Patient_Block_Keys (Block_Key, Patient_ID)
+                    SELECT Block_Key, %s FROM Patient_Block_Keys WHERE Patient_ID = %s
+                """, (keep_id, drop_id))
+                cursor.execute("DELETE FROM Patient_Block_Keys WHERE Patient_ID = %s", (drop_id,))
+                cursor.execute("DELETE FROM patients WHERE Patient_ID = %s", (drop_id,))
+                # A shared email means a shared login, which stays with keep_id.
+                drop_email = (emails[drop_id] or '').strip().lower()
+                if drop_email and drop_email != (emails[keep_id] or '').strip().lower():
+                    cursor.execute("DELETE FROM users WHERE username = %s AND role = 'patient'", (emails[drop_id],))
+                db.bump_version(cursor, 'patient', drop_id)
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                print(f"Error during merge: {str(e)}")
+                raise
+        audit.log('merge', actor, patient_id=keep_id)
+        print("Patients merged successfully.")
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+        print(f"Indexed {rebuild_keys()} blocking keys.")
+    for s, a, b in find_all_duplicates():
+        print(f"{s:.3f}\t{a}\t{b}")
@@ -44,6 +44,11 @@ CREATE TABLE Appointments (
     Appointment_Date DATE,
     Appointment_Time TIME,
     Appointment_Status ENUM('Completed', 'Upcoming') NOT NULL DEFAULT 'Upcoming',
+    Updated_At TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+    INDEX (Updated_At),
+    INDEX (Appointment_Date),
+    INDEX Appointments_Patient_Date (Patient_ID, Appointment_Date, Appointment_Time),
+    UNIQUE KEY Appointments_Doctor_Slot (Doctor_ID, Appointment_Date, Appointment_Time),
     FOREIGN KEY (Patient_ID) REFERENCES Patients(Patient_ID) ON DELETE CASCADE,
     FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
 );
@@ -53,8 +58,12 @@ CREATE TABLE Medical_Record (
     Patient_ID INT,
     Doctor_ID INT,
     Record_Date DATE,
-    Diagnosis TEXT,
-    Treatment TEXT,
+    -- First line of each note; the full text is in Clinical_Notes
+    Diagnosis_Summary VARCHAR(200),
+    Treatment_Summary VARCHAR(200),
+    INDEX Medical_Record_Date (Record_Date, Record_ID),
+    INDEX (Diagnosis_Summary),
+    INDEX Medical_Record_Patient_Date (Patient_ID, Record_Date),
     FOREIGN KEY (Patient_ID) REFERENCES Patients(Patient_ID) ON DELETE CASCADE,
     FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
 );
@@ -73,6 +82,9 @@ CREATE TABLE Prescriptions (
     Quantity INT,
     Start_Date DATE,
     End_Date DATE,
+    Billing_Run_ID INT NULL,
+    INDEX (Record_ID, Billing_Run_ID),
+    INDEX Prescriptions_Record_Start (Record_ID, Start_Date),
     FOREIGN KEY (Record_ID) REFERENCES Medical_Record(Record_ID) ON DELETE CASCADE,
     FOREIGN KEY (Medicine_ID) REFERENCES Medications(Medicine_ID) ON DELETE CASCADE
 );
@@ -83,6 +95,10 @@ CREATE TABLE Bills (
     Bill_Date DATE,
     Payment_Status ENUM('Paid', 'Partial', 'Unpaid') NOT NULL DEFAULT 'Unpaid',
     Amount DECIMAL(10, 2),
+    Record_ID INT NULL,
+    Billing_Run_ID INT NULL,
+    INDEX (Record_ID),
+    INDEX Bills_Patient_Date (Patient_ID, Bill_Date),
     FOREIGN KEY (Patient_ID) REFERENCES Patients(Patient_ID) ON DELETE CASCADE
 );
 
@@ -98,3 +114,125 @@ CREATE TABLE Prescription_Frequencies (
     Frequency VARCHAR(50),
     PRIMARY KEY (Prescription_ID, Frequency)
 );
+
+-- Change notification for per-process caches (see cache.py)
+CREATE TABLE Change_Sequence (
+    Seq_ID TINYINT PRIMARY KEY,
+    Last_Version BIGINT NOT NULL
+);
+
+INSERT INTO Change_Sequence (Seq_ID, Last_Version) VALUES (1, 0);
+
+CREATE TABLE Entity_Versions (
+    Entity VARCHAR(20),
+    Entity_ID INT,
+    Version BIGINT NOT NULL,
+    PRIMARY KEY (Entity, Entity_ID),
+    INDEX (Version)
+);
+
+-- Medical record access audit (written in batches by audit.py)
+CREATE TABLE Audit_Log (
+    Audit_ID BIGINT PRIMARY KEY AUTO_INCREMENT,
+    Event_Time DATETIME(6) NOT NULL,
+    Actor_Role VARCHAR(20),
+    Actor_ID INT,
+    Action VARCHAR(30) NOT NULL,
+    Patient_ID INT,
+    Record_ID INT,
+    INDEX (Record_ID, Event_Time),
+    INDEX (Patient_ID, Event_Time)
+);
+
+-- Blocking keys for duplicate patient detection (see dedup.py)
+CREATE TABLE Patient_Block_Keys (
+    Block_Key VARCHAR(120),
+    Patient_ID INT,
+    PRIMARY KEY (Block_Key, Patient_ID),
+    INDEX (Patient_ID)
+);
+
+-- Doctors' booked slots, kept on the home site (the first in HMS_SHARDS) for
+-- appointments on every site; each booking claims its slot here first (see
+-- db.claim_slot). Rebuilt from the appointments by rollups.py.
+CREATE TABLE Doctor_Slots (
+    Doctor_ID INT,
+    Slot_Date DATE,
+    Slot_Time TIME,
+    Claimed_At TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (Doctor_ID, Slot_Date, Slot_Time),
+    FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
+);
+
+-- Per-doctor, per-day counts of those slots for auto-assignment (home site)
+CREATE TABLE Doctor_Daily_Load (
+    Doctor_ID INT,
+    Load_Date DATE,
+    Booked INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (Doctor_ID, Load_Date),
+    FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
+);
+
+-- Hourly bookings per department and doctor (kept by db.adjust_load,
+-- backfilled by rollups.py)
+CREATE TABLE Occupancy_Hourly (
+    Slot_Date DATE,
+    Dept_ID INT,
+    Slot_Hour TINYINT,
+    Doctor_ID INT,
+    Booked INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (Slot_Date, Dept_ID, Slot_Hour, Doctor_ID),
+    FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
+);
+
+-- Set-based billing from prescriptions (see billing.py). A prescription is
+-- billed once: the run that claims it stamps Billing_Run_ID on it, and the
+-- bill it produced carries the same run and record.
+CREATE TABLE Billing_Runs (
+    Billing_Run_ID INT PRIMARY KEY AUTO_INCREMENT,
+    Started_At DATETIME NOT NULL,
+    From_Date DATE,
+    To_Date DATE,
+    Bills_Created INT NOT NULL DEFAULT 0
+);
+
+-- Multi-site deployments (see shards.py): run this script on every site
+-- database, and give each site's server
+--     auto_increment_increment = <HMS_SHARD_SLOTS>
+--     auto_increment_offset    = <the site's slot>
+-- before any rows are inserted, so generated IDs identify their site.
+
+-- Appointment reminders (see reminders.py); they poll Appointments.Updated_At.
+CREATE TABLE Reminders_Sent (
+    Appointment_ID INT,
+    Slot DATETIME,
+    Sent_At DATETIME NOT NULL,
+    PRIMARY KEY (Appointment_ID, Slot)
+);
+
+-- Pharmacy stock, per site (see db.take_stock). Each medicine's count is
+-- split over HMS_STOCK_STRIPES rows; medicines without rows are untracked.
+CREATE TABLE Medication_Stock (
+    Medicine_ID INT,
+    Slot TINYINT,
+    Quantity INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (Medicine_ID, Slot),
+    FOREIGN KEY (Medicine_ID) REFERENCES Medications(Medicine_ID) ON DELETE CASCADE,
+    CHECK (Quantity >= 0)
+);
+
+CREATE TABLE Medication_Reorder_Levels (
+    Medicine_ID INT PRIMARY KEY,
+    Reorder_Level INT NOT NULL,
+    FOREIGN KEY (Medicine_ID) REFERENCES Medications(Medicine_ID) ON DELETE CASCADE
+);
+
+-- Clinical notes, compressed and kept off Medical_Record (see notes.py).
+-- Listings read the summaries; full text is fetched when a record is opened.
+CREATE TABLE Clinical_Notes (
+    Record_ID INT,
+    Field ENUM('diagnosis', 'treatment'),
+    Body MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (Record_ID, Field),
+    FOREIGN KEY (Record_ID) REFERENCES Medical_Record(Record_ID) ON DELETE CASCADE
+);
@@ -0,0 +1,18 @@
+-- Upgrades an existing hdb database for the version-polled caches (cache.py,
+-- names.py). db.bump_version needs the seeded Change_Sequence row.
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Change_Sequence (
+    Seq_ID TINYINT PRIMARY KEY,
+    Last_Version BIGINT NOT NULL
+);
+
+INSERT IGNORE INTO Change_Sequence (Seq_ID, Last_Version) VALUES (1, 0);
+
+CREATE TABLE IF NOT EXISTS Entity_Versions (
+    Entity VARCHAR(20),
+    Entity_ID INT,
+    Version BIGINT NOT NULL,
+    PRIMARY KEY (Entity, Entity_ID),
+    INDEX (Version)
+);
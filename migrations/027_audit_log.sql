@@ -0,0 +1,16 @@
+-- Upgrades an existing hdb database for the medical record access audit
+-- (audit.py). Without this table the flusher cannot write and record views
+-- start failing once its queue is full.
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Audit_Log (
+    Audit_ID BIGINT PRIMARY KEY AUTO_INCREMENT,
+    Event_Time DATETIME(6) NOT NULL,
+    Actor_Role VARCHAR(20),
+    Actor_ID INT,
+    Action VARCHAR(30) NOT NULL,
+    Patient_ID INT,
+    Record_ID INT,
+    INDEX (Record_ID, Event_Time),
+    INDEX (Patient_ID, Event_Time)
+);
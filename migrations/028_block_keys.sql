@@ -0,0 +1,12 @@
+-- Upgrades an existing hdb database for duplicate patient detection
+-- (dedup.py); db.register_patient writes these keys. Afterwards index the
+-- patients already registered with
+--     python dedup.py rebuild
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Patient_Block_Keys (
+    Block_Key VARCHAR(120),
+    Patient_ID INT,
+    PRIMARY KEY (Block_Key, Patient_ID),
+    INDEX (Patient_ID)
+);
@@ -0,0 +1,26 @@
+-- Upgrades an existing hdb database for doctor auto-assignment: adds the
+-- per-day load counters, backfills them, and makes a doctor's slot unique.
+-- The unique key fails if a doctor is already double-booked; move or delete
+-- the duplicates reported by
+--     SELECT Doctor_ID, Appointment_Date, Appointment_Time, COUNT(*)
+--     FROM Appointments GROUP BY 1, 2, 3 HAVING COUNT(*) > 1;
+-- first.
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Doctor_Daily_Load (
+    Doctor_ID INT,
+    Load_Date DATE,
+    Booked INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (Doctor_ID, Load_Date),
+    FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
+);
+
+ALTER TABLE Appointments
+    ADD UNIQUE KEY Appointments_Doctor_Slot (Doctor_ID, Appointment_Date, Appointment_Time);
+
+INSERT INTO Doctor_Daily_Load (Doctor_ID, Load_Date, Booked)
+SELECT Doctor_ID, Appointment_Date, COUNT(*)
+FROM Appointments
+WHERE Doctor_ID IS NOT NULL AND Appointment_Date IS NOT NULL
+GROUP BY Doctor_ID, Appointment_Date
+ON DUPLICATE KEY UPDATE Booked = VALUES(Booked);
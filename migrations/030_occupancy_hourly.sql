@@ -0,0 +1,15 @@
+-- Upgrades an existing hdb database for the occupancy heatmap: hourly
+-- bookings per department and doctor, kept by db.adjust_load. Run on every
+-- site, then fill it from the existing appointments with
+--     python rollups.py
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Occupancy_Hourly (
+    Slot_Date DATE,
+    Dept_ID INT,
+    Slot_Hour TINYINT,
+    Doctor_ID INT,
+    Booked INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (Slot_Date, Dept_ID, Slot_Hour, Doctor_ID),
+    FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
+);
@@ -0,0 +1,21 @@
+-- Upgrades an existing hdb database for set-based billing (billing.py).
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Billing_Runs (
+    Billing_Run_ID INT PRIMARY KEY AUTO_INCREMENT,
+    Started_At DATETIME NOT NULL,
+    From_Date DATE,
+    To_Date DATE,
+    Bills_Created INT NOT NULL DEFAULT 0
+);
+
+ALTER TABLE Prescriptions
+    ADD COLUMN Billing_Run_ID INT NULL,
+    ADD INDEX (Record_ID, Billing_Run_ID);
+
+ALTER TABLE Bills
+    ADD COLUMN Record_ID INT NULL,
+    ADD COLUMN Billing_Run_ID INT NULL,
+    ADD INDEX (Record_ID);
+
+CREATE INDEX Medical_Record_Date ON Medical_Record (Record_Date, Record_ID);
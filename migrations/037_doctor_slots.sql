@@ -0,0 +1,22 @@
+-- Upgrades an existing hdb database for slot claims across sites: every
+-- booking claims its doctor's slot in Doctor_Slots on the home site (the
+-- first site in HMS_SHARDS), whose Doctor_Daily_Load then counts bookings
+-- from all sites. Run on every site, then fill the claims and loads from all
+-- sites' appointments with
+--     python rollups.py
+-- (the statement below only covers a single-site deployment).
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Doctor_Slots (
+    Doctor_ID INT,
+    Slot_Date DATE,
+    Slot_Time TIME,
+    Claimed_At TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (Doctor_ID, Slot_Date, Slot_Time),
+    FOREIGN KEY (Doctor_ID) REFERENCES Doctors(Doctor_ID) ON DELETE CASCADE
+);
+
+INSERT IGNORE INTO Doctor_Slots (Doctor_ID, Slot_Date, Slot_Time)
+SELECT Doctor_ID, Appointment_Date, Appointment_Time
+FROM Appointments
+WHERE Doctor_ID IS NOT NULL AND Appointment_Date IS NOT NULL AND Appointment_Time IS NOT NULL;
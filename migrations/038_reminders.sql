@@ -0,0 +1,14 @@
+-- Upgrades an existing hdb database for appointment reminders (reminders.py).
+USE hdb;
+
+ALTER TABLE Appointments
+    ADD COLUMN Updated_At TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+    ADD INDEX (Updated_At),
+    ADD INDEX (Appointment_Date);
+
+CREATE TABLE IF NOT EXISTS Reminders_Sent (
+    Appointment_ID INT,
+    Slot DATETIME,
+    Sent_At DATETIME NOT NULL,
+    PRIMARY KEY (Appointment_ID, Slot)
+);
@@ -0,0 +1,19 @@
+-- Upgrades an existing hdb database for pharmacy stock (db.take_stock, run by
+-- every create_prescription). Medicines start untracked; restock them from
+-- the admin Medications tab to start counting.
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Medication_Stock (
+    Medicine_ID INT,
+    Slot TINYINT,
+    Quantity INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (Medicine_ID, Slot),
+    FOREIGN KEY (Medicine_ID) REFERENCES Medications(Medicine_ID) ON DELETE CASCADE,
+    CHECK (Quantity >= 0)
+);
+
+CREATE TABLE IF NOT EXISTS Medication_Reorder_Levels (
+    Medicine_ID INT PRIMARY KEY,
+    Reorder_Level INT NOT NULL,
+    FOREIGN KEY (Medicine_ID) REFERENCES Medications(Medicine_ID) ON DELETE CASCADE
+);
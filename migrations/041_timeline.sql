@@ -0,0 +1,8 @@
+-- Upgrades an existing hdb database for the patient timeline (timeline.py):
+-- each source is read newest first within one patient.
+USE hdb;
+
+CREATE INDEX Appointments_Patient_Date ON Appointments (Patient_ID, Appointment_Date, Appointment_Time);
+CREATE INDEX Medical_Record_Patient_Date ON Medical_Record (Patient_ID, Record_Date);
+CREATE INDEX Bills_Patient_Date ON Bills (Patient_ID, Bill_Date);
+CREATE INDEX Prescriptions_Record_Start ON Prescriptions (Record_ID, Start_Date);
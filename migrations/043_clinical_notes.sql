@@ -0,0 +1,30 @@
+-- Upgrades an existing hdb database to compressed clinical notes (notes.py):
+-- moves Medical_Record's Diagnosis and Treatment text into Clinical_Notes,
+-- keeps a first-line summary on the record, then drops the TEXT columns.
+-- Take a backup first (backup.py); the last statement is not reversible.
+USE hdb;
+
+CREATE TABLE IF NOT EXISTS Clinical_Notes (
+    Record_ID INT,
+    Field ENUM('diagnosis', 'treatment'),
+    Body MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (Record_ID, Field),
+    FOREIGN KEY (Record_ID) REFERENCES Medical_Record(Record_ID) ON DELETE CASCADE
+);
+
+ALTER TABLE Medical_Record
+    ADD COLUMN Diagnosis_Summary VARCHAR(200),
+    ADD COLUMN Treatment_Summary VARCHAR(200),
+    ADD INDEX (Diagnosis_Summary);
+
+INSERT INTO Clinical_Notes (Record_ID, Field, Body)
+SELECT Record_ID, 'diagnosis', COMPRESS(Diagnosis) FROM Medical_Record WHERE Diagnosis IS NOT NULL
+ON DUPLICATE KEY UPDATE Body = VALUES(Body);
+INSERT INTO Clinical_Notes (Record_ID, Field, Body)
+SELECT Record_ID, 'treatment', COMPRESS(Treatment) FROM Medical_Record WHERE Treatment IS NOT NULL
+ON DUPLICATE KEY UPDATE Body = VALUES(Body);
+UPDATE Medical_Record SET
+    Diagnosis_Summary = LEFT(SUBSTRING_INDEX(TRIM(Diagnosis), '\n', 1), 200),
+    Treatment_Summary = LEFT(SUBSTRING_INDEX(TRIM(Treatment), '\n', 1), 200);
+
+ALTER TABLE Medical_Record DROP COLUMN Diagnosis, DROP COLUMN Treatment;
@@ -0,0 +1,49 @@
+from collections import namedtuple
+
+# Row types returned by db.py. They are built straight from tuple cursors, so
+# a row costs one tuple instead of a dict per row and fields are read as
+# attributes (bill.amount) with one consistent snake_case spelling.
+
+Patient = namedtuple("Patient", [
+    "patient_id", "patient_name", "date_of_birth", "gender", "email", "phone_number", "address",
+])
+
+Doctor = namedtuple("Doctor", [
+    "doctor_id", "doctor_name", "phone_number", "email", "dept_id", "department_name",
+])
+
+Appointment = namedtuple("Appointment", [
+    "appointment_id", "patient_id", "doctor_id", "appointment_date", "appointment_time", "appointment_status",
+])
+
+MedicalRecord = namedtuple("MedicalRecord", [
+    "record_id", "patient_id", "doctor_id", "record_date", "diagnosis_summary", "treatment_summary",
+])
+
+Prescription = namedtuple("Prescription", [
+    "prescription_id", "record_id", "medicine_id", "quantity", "start_date", "end_date",
+])
+
+Bill = namedtuple("Bill", [
+    "bill_id", "patient_id", "bill_date", "payment_status", "amount",
+])
+
+Medication = namedtuple("Medication", [
+    "medicine_id", "medicine_name", "dosage", "price",
+])
+
+Department = namedtuple("Department", [
+    "dept_id", "department_name", "location",
+])
+
+# One row per prescription on a record (db.get_all_records).
+RecordMedicine = namedtuple("RecordMedicine", [
+    "record_id", "patient_id", "doctor_id", "medicine_id",
+])
+
+TimelineEvent = namedtuple("TimelineEvent", [
+    "at", "kind", "item_id", "doctor_id", "detail",
+])
+
+def fetch_all(cursor, row_type):
+    return [row_type._make(row) for row in cursor.fetchall()]
@@ -0,0 +1,151 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+import cache
+import db
+import routing
+import shards
+
+# ID -> display name for the foreign keys shown in list views, so queries can
+# return bare IDs instead of joining patients/doctors every time. Each entity
+# is a sorted array of IDs plus a parallel list of interned names, about a
+# tenth of the memory of a dict of rows. It is loaded once per process and
+# kept current through the Entity_Versions polling in cache.py.
+
+_QUERIES = {
+    'patient': ("Patient_ID", 'SELECT Patient_ID, CONCAT(First_Name, " ", Last_Name) FROM patients'),
+    'doctor': ("Doctor_ID", 'SELECT Doctor_ID, CONCAT(First_Name, " ", Last_Name) FROM doctors'),
+    'department': ("Dept_ID", "SELECT Dept_ID, Department_Name FROM departments"),
+    'medication': ("Medicine_ID", "SELECT Medicine_ID, Medicine_Name FROM medications"),
+}
+
+# Foreign key column -> (entity, display column added next to it)
+_COLUMNS = {
+    'patient_id': ('patient', 'Patient_Name'),
+    'doctor_id': ('doctor', 'Doctor_Name'),
+    'dept_id': ('department', 'Department_Name'),
+    'medicine_id': ('medication', 'Medicine_Name'),
+}
+
+# Above this many changed IDs a full reload is cheaper than patching arrays.
+RELOAD_THRESHOLD = 1000
+
+class _Names:
+    __slots__ = ("ids", "names")
+
+    def __init__(self, rows):
+        rows = sorted(rows)
+        self.ids = array('i', [row[0] for row in rows])
+        self.names = [sys.intern(row[1]) if row[1] else "" for row in rows]
+
+    def get(self, entity_id):
+        # Nullable foreign keys (e.g. a bill's doctor in the timeline) have no name.
+        if entity_id is None:
+            return None
+        i = bisect_left(self.ids, entity_id)
+        if i < len(self.ids) and self.ids[i] == entity_id:
+            return self.names[i]
+        return None
+
+    def remove(self, entity_id):
+        i = bisect_left(self.ids, entity_id)
+        if i < len(self.ids) and self.ids[i] == entity_id:
+            del self.ids[i]
+            del self.names[i]
+
+    def put(self, entity_id, name):
+        self.remove(entity_id)
+        i = bisect_left(self.ids, entity_id)
+        self.ids.insert(i, entity_id)
+        self.names.insert(i, sys.intern(name) if name else "")
+
+_lock = threading.Lock()
+_tables = {}
+
+def _fetch_site(entity, ids):
+    column, sql = _QUERIES[entity]
+    args = None
+    if ids is not None:
+        sql += " WHERE %s IN (%s)" % (column, ", ".join(["%s"] * len(ids)))
+        args = list(ids)
+    # Primary, not a replica, so a refetch after a change sees that change.
+    with routing.primary():
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, args)
+            return [tuple(row.values()) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+def _fetch(entity, ids=None):
+    # Patients are spread over the sites; the other entities are copied to
+    # every site, so the home site has them all.
+    if entity == 'patient':
+        return [row for rows in shards.run_all(lambda: _fetch_site(entity, ids)) for row in rows]
+    with shards.use(shards.home()):
+        return _fetch_site(entity, ids)
+
+def _on_change(changed):
+    with _lock:
+        for entity, ids in changed.items():
+            table = _tables.get(entity)
+            if table is None:
+                continue
+            if len(ids) > RELOAD_THRESHOLD:
+                _tables[entity] = _Names(_fetch(entity))
+                continue
+            for entity_id in ids:
+                table.remove(entity_id)
+            for entity_id, name in _fetch(entity, ids):
+                table.put(entity_id, name)
+
+cache.subscribe(_on_change)
+
+def _table(entity):
+    table = _tables.get(entity)
+    if table is None:
+        with _lock:
+            table = _tables.get(entity)
+            if table is None:
+                table = _tables[entity] = _Names(_fetch(entity))
+    return table
+
+def name(entity, entity_id):
+    cache.sync()
+    return _table(entity).get(entity_id)
+
+def enrich(rows):
+    # Adds Patient_Name/Doctor_Name/... (patient_name/... for the row types in
+    # models.py) next to each ID column a row has, unless the query already
+    # returned that name. Returns dicts ready for a DataFrame.
+    if not rows:
+        return rows
+    if hasattr(rows[0], "_asdict"):
+        rows = [row._asdict() for row in rows]
+    elif not isinstance(rows[0], dict):
+        return rows
+    cache.sync()
+    first = rows[0]
+    lookups = []
+    for key in first:
+        spec = _COLUMNS.get(key.lower())
+        if spec is None:
+            continue
+        name_key = spec[1].lower() if key.islower() else spec[1]
+        if name_key not in first:
+            lookups.append((key, name_key, _table(spec[0])))
+    if not lookups:
+        return rows
+    enriched = []
+    for row in rows:
+        out = {}
+        for key, value in row.items():
+            out[key] = value
+            for id_key, name_key, table in lookups:
+                if key == id_key:
+                    out[name_key] = table.get(value)
+        enriched.append(out)
+    return enriched
@@ -0,0 +1,28 @@
+import zlib
+
+# Full diagnosis and treatment text lives compressed in Clinical_Notes; the
+# record itself only carries a short summary for listings. Bodies use MySQL's
+# COMPRESS() layout (4-byte little-endian length, then zlib), so the migration
+# (migrations/043_clinical_notes.sql) can backfill with COMPRESS() and
+# UNCOMPRESS() reads them in ad hoc queries.
+
+FIELDS = ("diagnosis", "treatment")
+SUMMARY_LENGTH = 200
+
+def pack(text):
+    raw = text.encode("utf-8")
+    if not raw:
+        return b""
+    return len(raw).to_bytes(4, "little") + zlib.compress(raw)
+
+def unpack(body):
+    if not body:
+        return ""
+    return zlib.decompress(body[4:]).decode("utf-8")
+
+def summary(text):
+    # First line, cut to fit Medical_Record's summary columns.
+    if text is None:
+        return None
+    lines = text.strip().splitlines()
+    return lines[0][:SUMMARY_LENGTH] if lines else ""
@@ -0,0 +1,287 @@
+import heapq
+import os
+import smtplib
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import db
+import names
+import resilience
+import routing
+import shards
+
+# Reminder dispatcher for 'Upcoming' appointments.
+#
+# Appointments inside the LOOKAHEAD window are loaded once into a heap
+# ordered by reminder time. Afterwards only rows whose Updated_At moved are
+# read back, every POLL_INTERVAL seconds, so bookings and reschedules made
+# through db.py reach the heap without rescanning Appointments. Updated_At is
+# stamped when a row is written, not when it commits, so each poll reaches
+# back CHANGE_OVERLAP before the newest stamp seen; all reads go to the
+# primary, whose clock and commits the stamps come from. A moved
+# appointment just gets a new heap entry; the old one no longer matches
+# _current and is dropped when it surfaces. Deletes and status changes are
+# caught by re-reading each due batch right before sending.
+#
+#   python reminders.py [console|smtp]
+
+REMIND_BEFORE = timedelta(hours=int(os.environ.get('HMS_REMIND_BEFORE_HOURS', 24)))
+LOOKAHEAD = timedelta(days=7)
+POLL_INTERVAL = 30.0
+WINDOW_INTERVAL = 3600.0
+BATCH_SIZE = 200
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60.0
+# Longer than any transaction that writes Appointments is kept open.
+CHANGE_OVERLAP = timedelta(seconds=int(os.environ.get('HMS_REMIND_OVERLAP_SECONDS', 300)))
+
+SMTP_HOST = os.environ.get('HMS_SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('HMS_SMTP_PORT', 1025))
+SMTP_FROM = os.environ.get('HMS_SMTP_FROM', 'reminders@hospital.local')
+
+class ConsoleSender:
+    def send_batch(self, reminders):
+        for reminder in reminders:
+            print(f"Reminder to {reminder['email']}: {reminder['subject']}")
+        return []
+
+class SmtpSender:
+    # Works against any SMTP server; for local runs start a stand-in with
+    #   python -m aiosmtpd -n -l localhost:1025
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, sender=SMTP_FROM):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def send_batch(self, reminders):
+        # One SMTP session per batch; returns the reminders that failed.
+        failed = []
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            for reminder in reminders:
+                message = EmailMessage()
+                message['From'] = self.sender
+                message['To'] = reminder['email']
+                message['Subject'] = reminder['subject']
+                message.set_content(reminder['body'])
+                try:
+                    smtp.send_message(message)
+                except smtplib.SMTPException as e:
+                    print(f"Reminder for appointment {reminder['appointment_id']} failed: {str(e)}")
+                    failed.append(reminder)
+        return failed
+
+_lock = threading.Lock()
+_heap = []          # (remind_at, appointment_id, slot, attempt)
+_current = {}       # appointment_id -> slot currently scheduled
+_sent = set()       # (appointment_id, slot) already delivered
+_seen_until = {}    # site -> newest Updated_At read
+_window_end = None
+_last_poll = 0.0
+_last_window = 0.0
+
+_SELECT = """
+    SELECT Appointment_ID, Appointment_Date, Appointment_Time, Appointment_Status, Updated_At
+    FROM appointments
+"""
+
+def _slot(row):
+    return datetime.combine(row['Appointment_Date'], datetime.min.time()) + row['Appointment_Time']
+
+def _schedule(row):
+    apt_id = row['Appointment_ID']
+    if row['Appointment_Status'] != 'Upcoming':
+        _current.pop(apt_id, None)
+        return
+    slot = _slot(row)
+    if slot < datetime.now() or slot > datetime.now() + LOOKAHEAD:
+        _current.pop(apt_id, None)
+        return
+    if _current.get(apt_id) == slot or (apt_id, slot) in _sent:
+        return
+    _current[apt_id] = slot
+    heapq.heappush(_heap, (slot - REMIND_BEFORE, apt_id, slot, 0))
+
+def _query_site(sql, args):
+    with resilience.deadline(None), routing.primary():
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, args)
+            return shards.current()['site'], cursor.fetchall()
+    finally:
+        connection.close()
+
+def _absorb(results):
+    for site, rows in results:
+        for row in rows:
+            _schedule(row)
+            if row['Updated_At'] and (site not in _seen_until or row['Updated_At'] > _seen_until[site]):
+                _seen_until[site] = row['Updated_At']
+
+def _prune(now):
+    # Slots already past can no longer be reminded of.
+    _sent.difference_update([key for key in _sent if key[1] < now])
+    for apt_id in [apt_id for apt_id, slot in _current.items() if slot < now]:
+        del _current[apt_id]
+
+def load_window():
+    # Appointments entering the look-ahead window; run at start and hourly.
+    global _window_end, _last_window
+    if _window_end is None:
+        # Changes are polled from the database's clock as of now, taken
+        # before the window is read so nothing in between is lost.
+        for site, rows in shards.run_all(lambda: _query_site("SELECT NOW(3) AS Now", None)):
+            _seen_until.setdefault(site, rows[0]['Now'])
+    start = datetime.now().date() if _window_end is None else _window_end
+    end = (datetime.now() + LOOKAHEAD).date()
+    sql = _SELECT + " WHERE Appointment_Date BETWEEN %s AND %s AND Appointment_Status = 'Upcoming'"
+    with _lock:
+        _prune(datetime.now())
+        _absorb(shards.run_all(lambda: _query_site(sql, (start, end))))
+        _window_end = end
+        _last_window = time.monotonic()
+
+def poll_changes():
+    global _last_poll
+    # Rows stamped up to CHANGE_OVERLAP before the newest one seen may have
+    # committed since, so they are read again; _schedule ignores what it
+    # already has.
+    sql = _SELECT + " WHERE Updated_At >= %s"
+    with _lock:
+        _absorb(shards.run_all(lambda: _query_site(sql, (_seen_until[shards.current()['site']] - CHANGE_OVERLAP,))))
+        _last_poll = time.monotonic()
+
+def _pop_due(now):
+    due = []
+    while _heap and _heap[0][0] <= now and len(due) < BATCH_SIZE:
+        remind_at, apt_id, slot, attempt = heapq.heappop(_heap)
+        if _current.get(apt_id) == slot and (apt_id, slot) not in _sent:
+            due.append((apt_id, slot, attempt))
+    return due
+
+def _confirm(due):
+    # Re-read the due appointments (grouped by site) so deleted, completed or
+    # moved ones are not reminded, and pick up the patient's email.
+    by_site = {}
+    for apt_id, slot, attempt in due:
+        by_site.setdefault(shards.shard_for_id(apt_id)['site'], []).append(apt_id)
+    rows = {}
+    for shard in shards.SHARDS:
+        ids = by_site.get(shard['site'])
+        if not ids:
+            continue
+        sql = """
+            SELECT a.Appointment_ID, a.Doctor_ID, a.Appointment_Date, a.Appointment_Time,
+            a.Appointment_Status, p.Email, CONCAT(p.First_Name, " ", p.Last_Name) AS Patient_Name,
+            r.Appointment_ID AS Already_Sent
+            FROM appointments AS a
+            INNER JOIN patients AS p ON p.Patient_ID = a.Patient_ID
+            LEFT JOIN Reminders_Sent AS r
+                ON r.Appointment_ID = a.Appointment_ID
+                AND r.Slot = TIMESTAMP(a.Appointment_Date, a.Appointment_Time)
+            WHERE a.Appointment_ID IN (%s)
+        """ % ", ".join(["%s"] * len(ids))
+        with shards.use(shard):
+            for row in _query_site(sql, ids)[1]:
+                rows[row['Appointment_ID']] = row
+    reminders = []
+    for apt_id, slot, attempt in due:
+        row = rows.get(apt_id)
+        if row is None or row['Appointment_Status'] != 'Upcoming' or _slot(row) != slot:
+            continue
+        if row['Already_Sent'] is not None:
+            _sent.add((apt_id, slot))
+            continue
+        doctor = names.name('doctor', row['Doctor_ID']) or f"doctor {row['Doctor_ID']}"
+        reminders.append({
+            'appointment_id': apt_id,
+            'slot': slot,
+            'attempt': attempt,
+            'email': row['Email'],
+            'subject': f"Appointment reminder: {slot:%d %b %Y %H:%M}",
+            'body': f"Dear {row['Patient_Name']},\n\nThis is a reminder of your appointment with {doctor} on {slot:%A %d %B %Y at %H:%M}.\n",
+        })
+    return reminders
+
+def _record_sent(reminders):
+    by_site = {}
+    for reminder in reminders:
+        by_site.setdefault(shards.shard_for_id(reminder['appointment_id'])['site'], []).append(
+            (reminder['appointment_id'], reminder['slot'])
+        )
+    for shard in shards.SHARDS:
+        rows = by_site.get(shard['site'])
+        if not rows:
+            continue
+        with shards.use(shard):
+            connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                sql = "INSERT IGNORE INTO Reminders_Sent (Appointment_ID, Slot, Sent_At) VALUES (%s, %s, NOW())"
+                cursor.executemany(sql, rows)
+            connection.commit()
+        finally:
+            connection.close()
+
+def dispatch_due(sender):
+    with _lock:
+        due = _pop_due(datetime.now())
+    if not due:
+        return 0
+    try:
+        reminders = _confirm(due)
+    except Exception:
+        # Put them back; they are still _current and would not be rescheduled.
+        with _lock:
+            for apt_id, slot, attempt in due:
+                heapq.heappush(_heap, (datetime.now() + timedelta(seconds=RETRY_DELAY), apt_id, slot, attempt))
+        raise
+    if not reminders:
+        return 0
+    try:
+        failed = sender.send_batch(reminders)
+    except Exception as e:
+        print(f"Reminder batch failed: {str(e)}")
+        failed = reminders
+    failed_ids = {id(reminder) for reminder in failed}
+    delivered = [reminder for reminder in reminders if id(reminder) not in failed_ids]
+    with _lock:
+        for reminder in delivered:
+            _sent.add((reminder['appointment_id'], reminder['slot']))
+        for reminder in failed:
+            attempt = reminder['attempt'] + 1
+            if attempt < MAX_ATTEMPTS:
+                retry_at = datetime.now() + timedelta(seconds=RETRY_DELAY * 2 ** reminder['attempt'])
+                heapq.heappush(_heap, (retry_at, reminder['appointment_id'], reminder['slot'], attempt))
+            else:
+                print(f"Giving up on reminder for appointment {reminder['appointment_id']}.")
+    if delivered:
+        _record_sent(delivered)
+    return len(delivered)
+
+def run(sender, stop=None):
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        # A failed step (database down, deadline hit) is logged and tried
+        # again on a later pass; the dispatcher itself keeps running.
+        try:
+            if _window_end is None or time.monotonic() - _last_window >= WINDOW_INTERVAL:
+                load_window()
+            if time.monotonic() - _last_poll >= POLL_INTERVAL:
+                poll_changes()
+            while dispatch_due(sender):
+                pass
+        except Exception as e:
+            print(f"Reminder dispatcher error: {str(e)}")
+            stop.wait(POLL_INTERVAL)
+            continue
+        with _lock:
+            next_due = (_heap[0][0] - datetime.now()).total_seconds() if _heap else POLL_INTERVAL
+        stop.wait(min(max(next_due, 0.5), POLL_INTERVAL))
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "console"
+    run(SmtpSender() if mode == "smtp" else ConsoleSender())
@@ -0,0 +1,164 @@
+import contextvars
+import functools
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Timeouts (seconds) applied to every connection from db.get_connection.
+# A call's deadline caps all of them, so a stalled MySQL costs a session
+# thread at most DEFAULT_DEADLINE instead of hanging it.
+CONNECT_TIMEOUT = float(os.environ.get('HMS_DB_CONNECT_TIMEOUT', 3))
+DEFAULT_DEADLINE = float(os.environ.get('HMS_DB_DEADLINE', 10))
+# Server-side cap for SELECT statements (MAX_EXECUTION_TIME), in seconds.
+STATEMENT_TIMEOUT = float(os.environ.get('HMS_DB_STATEMENT_TIMEOUT', 5))
+
+# After BREAKER_THRESHOLD consecutive database failures every call fails fast
+# for BREAKER_COOLDOWN seconds, then a single trial call decides whether to
+# close the breaker again.
+BREAKER_THRESHOLD = int(os.environ.get('HMS_DB_BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.environ.get('HMS_DB_BREAKER_COOLDOWN', 15))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+# MySQL client/server error codes that mean the call ran out of time.
+_TIMEOUT_CODES = (2013, 3024)
+# Codes that say the server is unreachable or the connection died. Only these,
+# timeouts and InterfaceError (a connection already closed) count towards the
+# breaker; deadlocks, lock waits, constraint and SQL errors do not.
+_CONNECTION_CODES = (2003, 2006, 2013, 2055)
+
+class DatabaseUnavailable(Exception):
+    pass
+
+_deadline = contextvars.ContextVar('db_deadline', default=None)
+
+_lock = threading.Lock()
+_failures = 0
+_open_until = 0.0
+_trial_running = False
+_stats = {'calls': 0, 'failures': 0, 'timeouts': 0, 'rejected': 0}
+_histogram = [0] * len(LATENCY_BUCKETS)
+
+@contextmanager
+def deadline(seconds):
+    # Overrides the deadline for every db.py call inside the block; None means
+    # no limit (batch jobs).
+    token = _deadline.set(math.inf if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining():
+    end = _deadline.get()
+    if end is None:
+        return DEFAULT_DEADLINE
+    left = end - time.monotonic()
+    if left <= 0:
+        raise TimeoutError("Database deadline exceeded.")
+    return left
+
+def connect_kwargs():
+    left = remaining()
+    kwargs = {'connect_timeout': min(CONNECT_TIMEOUT, left)}
+    if left != math.inf:
+        kwargs['read_timeout'] = left
+        kwargs['write_timeout'] = left
+    statement_ms = 0 if left == math.inf else int(1000 * min(STATEMENT_TIMEOUT, left))
+    kwargs['init_command'] = "SET SESSION MAX_EXECUTION_TIME = %d" % statement_ms
+    return kwargs
+
+def breaker_open():
+    return _failures >= BREAKER_THRESHOLD
+
+def before_call():
+    global _trial_running
+    with _lock:
+        if _failures < BREAKER_THRESHOLD:
+            return
+        if time.monotonic() >= _open_until and not _trial_running:
+            _trial_running = True
+            return
+        _stats['rejected'] += 1
+    raise DatabaseUnavailable("Database is unavailable, try again shortly.")
+
+def _is_db_failure(e):
+    err = sys.modules.get('pymysql.err')
+    if isinstance(e, TimeoutError):
+        return True
+    if err is None:
+        return False
+    if isinstance(e, err.InterfaceError):
+        return True
+    return isinstance(e, err.OperationalError) and bool(e.args) and e.args[0] in _CONNECTION_CODES + _TIMEOUT_CODES
+
+def _is_timeout(e):
+    if isinstance(e, TimeoutError):
+        return True
+    return bool(e.args) and e.args[0] in _TIMEOUT_CODES
+
+def after_call(elapsed, error=None):
+    global _failures, _open_until, _trial_running
+    with _lock:
+        _stats['calls'] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                _histogram[i] += 1
+                break
+        was_trial = _trial_running
+        _trial_running = False
+        if error is None or not _is_db_failure(error):
+            # Application errors (bad input, constraint violations) say the
+            # database is up.
+            _failures = 0
+            return
+        _stats['failures'] += 1
+        if _is_timeout(error):
+            _stats['timeouts'] += 1
+        _failures += 1
+        if was_trial or _failures >= BREAKER_THRESHOLD:
+            _failures = max(_failures, BREAKER_THRESHOLD)
+            _open_until = time.monotonic() + BREAKER_COOLDOWN
+
+def db_call(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        before_call()
+        token = None
+        if _deadline.get() is None:
+            token = _deadline.set(time.monotonic() + DEFAULT_DEADLINE)
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            after_call(time.monotonic() - started, e)
+            raise
+        finally:
+            if token is not None:
+                _deadline.reset(token)
+        after_call(time.monotonic() - started)
+        return result
+    return wrapper
+
+def _percentile(counts, total, q):
+    target = q * total
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, counts):
+        seen += count
+        if seen >= target:
+            return bound
+    return math.inf
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+        counts = list(_histogram)
+        stats['breaker_open'] = _failures >= BREAKER_THRESHOLD
+    total = sum(counts)
+    stats['latency_buckets'] = dict(zip(LATENCY_BUCKETS, counts))
+    for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        stats[name] = _percentile(counts, total, q) if total else None
+    return stats
@@ -0,0 +1,135 @@
+import sys
+import time
+
+import db
+import resilience
+import shards
+
+# Doctors whose rollups are rebuilt per transaction.
+CHUNK_SIZE = 200
+# A claim this recent may belong to a booking whose appointment has not
+# committed on its site yet, so a rebuild keeps it.
+CLAIM_GRACE_SECONDS = 600
+
+_SQL_HOURLY = """
+    INSERT INTO Occupancy_Hourly (Slot_Date, Dept_ID, Slot_Hour, Doctor_ID, Booked)
+    SELECT a.Appointment_Date, d.Dept_ID, HOUR(a.Appointment_Time), a.Doctor_ID, COUNT(*)
+    FROM appointments AS a
+    INNER JOIN doctors AS d ON d.Doctor_ID = a.Doctor_ID
+    WHERE a.Doctor_ID BETWEEN %s AND %s
+    AND a.Appointment_Date IS NOT NULL AND a.Appointment_Time IS NOT NULL
+    GROUP BY a.Appointment_Date, d.Dept_ID, HOUR(a.Appointment_Time), a.Doctor_ID
+"""
+
+def backfill(chunk_size=CHUNK_SIZE):
+    chunks = sum(shards.run_all(lambda: _backfill_site(chunk_size)))
+    with shards.use(shards.home()):
+        return chunks + _rebuild_claims(chunk_size)
+
+def _doctor_bounds(cursor):
+    cursor.execute("SELECT MIN(Doctor_ID) AS lo, MAX(Doctor_ID) AS hi FROM doctors")
+    bounds = cursor.fetchone()
+    return bounds['lo'], bounds['hi']
+
+def _backfill_site(chunk_size):
+    # Recomputes Occupancy_Hourly from Appointments a range of doctors at a
+    # time, each range in one transaction: the range's appointments are
+    # share-locked first (the order bookings lock in), then its counters are
+    # replaced. Readers never see a range half done, bookings of those
+    # doctors wait for the commit and are counted once, and a rerun gives the
+    # same result.
+    with resilience.deadline(None):
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            lo, hi = _doctor_bounds(cursor)
+            connection.commit()
+            if lo is None:
+                return 0
+            started = time.monotonic()
+            chunks = 0
+            for first in range(lo, hi + 1, chunk_size):
+                last = first + chunk_size - 1
+                cursor.execute(
+                    "SELECT COUNT(*) AS n FROM appointments WHERE Doctor_ID BETWEEN %s AND %s LOCK IN SHARE MODE",
+                    (first, last)
+                )
+                cursor.execute("DELETE FROM Occupancy_Hourly WHERE Doctor_ID BETWEEN %s AND %s", (first, last))
+                cursor.execute(_SQL_HOURLY, (first, last))
+                connection.commit()
+                chunks += 1
+                print(f"{shards.current()['site']}: doctors {first}-{last} rolled up ({time.monotonic() - started:.1f}s)")
+            return chunks
+    finally:
+        connection.close()
+
+def _site_slots(lo, hi):
+    with resilience.deadline(None):
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT Doctor_ID, Appointment_Date, Appointment_Time
+                FROM appointments
+                WHERE Doctor_ID BETWEEN %s AND %s
+                AND Appointment_Date IS NOT NULL AND Appointment_Time IS NOT NULL
+            """, (lo, hi))
+            return [(row['Doctor_ID'], row['Appointment_Date'], row['Appointment_Time']) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+def _rebuild_claims(chunk_size):
+    # Doctor_Slots and Doctor_Daily_Load on the home site from every site's
+    # appointments, a range of doctors per transaction. The range's claims
+    # are locked first, so bookings of those doctors wait for the commit
+    # instead of racing the rebuild, and the other doctors are untouched.
+    with resilience.deadline(None):
+        connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            first, last = _doctor_bounds(cursor)
+            connection.commit()
+            if first is None:
+                return 0
+            chunks = 0
+            for lo in range(first, last + 1, chunk_size):
+                hi = lo + chunk_size - 1
+                cursor.execute("""
+                    SELECT Doctor_ID, Slot_Date, Slot_Time,
+                    Claimed_At > NOW() - INTERVAL %s SECOND AS Recent
+                    FROM Doctor_Slots
+                    WHERE Doctor_ID BETWEEN %s AND %s
+                    FOR UPDATE
+                """, (CLAIM_GRACE_SECONDS, lo, hi))
+                claims = {(row['Doctor_ID'], row['Slot_Date'], row['Slot_Time']): row['Recent'] for row in cursor.fetchall()}
+                booked = {slot for slots in shards.run_all(lambda: _site_slots(lo, hi)) for slot in slots}
+                booked.update(slot for slot, recent in claims.items() if recent)
+                stale = [slot for slot in claims if slot not in booked]
+                missing = [slot for slot in booked if slot not in claims]
+                if stale:
+                    cursor.executemany(
+                        "DELETE FROM Doctor_Slots WHERE Doctor_ID = %s AND Slot_Date = %s AND Slot_Time = %s", stale
+                    )
+                if missing:
+                    cursor.executemany(
+                        "INSERT INTO Doctor_Slots (Doctor_ID, Slot_Date, Slot_Time) VALUES (%s, %s, %s)", missing
+                    )
+                loads = {}
+                for doctor_id, date, time in booked:
+                    loads[(doctor_id, date)] = loads.get((doctor_id, date), 0) + 1
+                cursor.execute("DELETE FROM Doctor_Daily_Load WHERE Doctor_ID BETWEEN %s AND %s", (lo, hi))
+                if loads:
+                    cursor.executemany(
+                        "INSERT INTO Doctor_Daily_Load (Doctor_ID, Load_Date, Booked) VALUES (%s, %s, %s)",
+                        [(doctor_id, date, count) for (doctor_id, date), count in loads.items()]
+                    )
+                connection.commit()
+                chunks += 1
+                print(f"{shards.current()['site']}: slots of doctors {lo}-{hi} rebuilt ({len(stale)} released, {len(missing)} claimed)")
+            return chunks
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else CHUNK_SIZE
+    print(f"Backfilled {backfill(size)} chunks.")
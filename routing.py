@@ -0,0 +1,122 @@
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Read replicas as "host:port:weight" entries separated by commas, e.g.
+# HMS_DB_REPLICAS="10.0.0.2:3306:2,10.0.0.3:3306:1". User, password and
+# database are the primary's. With no replicas everything goes to the primary.
+def parse_replicas(value):
+    replicas = []
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        host, _, rest = entry.partition(":")
+        port, _, weight = rest.partition(":")
+        replicas.append({'host': host, 'port': int(port or 3306), 'weight': float(weight or 1)})
+    return replicas
+
+REPLICAS = parse_replicas(os.environ.get('HMS_DB_REPLICAS', ''))
+# After a session writes, its reads go to the primary for this long so it
+# sees its own changes despite replication lag.
+STICKY_SECONDS = float(os.environ.get('HMS_DB_STICKY_SECONDS', 5))
+# A replica that failed to connect is skipped for this long.
+REPLICA_RETRY = float(os.environ.get('HMS_DB_REPLICA_RETRY', 30))
+
+_LAST_WRITE_KEY = '_db_last_write'
+
+_read_only = contextvars.ContextVar('db_read_only', default=False)
+_on_primary = contextvars.ContextVar('db_on_primary', default=False)
+_session = contextvars.ContextVar('db_session', default=None)
+
+_lock = threading.Lock()
+_down_until = {}
+
+def use_session(state):
+    # Called at the start of every Streamlit run with st.session_state; any
+    # mutable mapping that lives as long as the user's session works.
+    _session.set(state)
+
+@contextmanager
+def reading():
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+def read_call(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with reading():
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def primary():
+    # Reads that must not lag (change polls and the refetches they trigger,
+    # logins): served by the primary, but unlike a write they do not pin the
+    # session's later reads to it.
+    read_token = _read_only.set(True)
+    primary_token = _on_primary.set(True)
+    try:
+        yield
+    finally:
+        _on_primary.reset(primary_token)
+        _read_only.reset(read_token)
+
+def primary_call(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with primary():
+            return func(*args, **kwargs)
+    return wrapper
+
+def _recent_write():
+    state = _session.get()
+    if state is None:
+        return False
+    last = state.get(_LAST_WRITE_KEY)
+    return last is not None and time.monotonic() - last < STICKY_SECONDS
+
+def _note_write():
+    state = _session.get()
+    if state is not None:
+        state[_LAST_WRITE_KEY] = time.monotonic()
+
+def _candidates(replicas):
+    now = time.monotonic()
+    with _lock:
+        healthy = [r for r in replicas if _down_until.get((r['host'], r['port']), 0) <= now]
+    # Weighted shuffle: the first entry is picked in proportion to its weight,
+    # the rest are the failover order.
+    return sorted(healthy, key=lambda r: random.random() ** (1.0 / r['weight']), reverse=True)
+
+def _mark_down(replica):
+    with _lock:
+        _down_until[(replica['host'], replica['port'])] = time.monotonic() + REPLICA_RETRY
+
+def connect(primary, open_connection, replicas=None):
+    # open_connection(config) opens a connection for one server's settings.
+    if replicas is None:
+        replicas = REPLICAS
+    if _read_only.get() and not _on_primary.get() and replicas and not _recent_write():
+        for replica in _candidates(replicas):
+            try:
+                return open_connection(dict(primary, host=replica['host'], port=replica['port']))
+            except Exception as e:
+                print(f"Replica {replica['host']}:{replica['port']} unavailable: {str(e)}")
+                _mark_down(replica)
+    connection = open_connection(primary)
+    if not _read_only.get():
+        _note_write()
+    return connection
+
+def replica_status(replicas=None):
+    now = time.monotonic()
+    with _lock:
+        return [
+            dict(r, healthy=_down_until.get((r['host'], r['port']), 0) <= now)
+            for r in (REPLICAS if replicas is None else replicas)
+        ]
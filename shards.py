@@ -0,0 +1,212 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# One hdb database per hospital site. Patients, and everything hanging off
+# them (appointments, records, prescriptions, bills), live on one site;
+# departments, doctors and medications are copied to every site.
+#
+# Each site's MySQL runs with auto_increment_increment = HMS_SHARD_SLOTS and
+# auto_increment_offset = its slot, so every ID it generates satisfies
+# id % HMS_SHARD_SLOTS == slot % HMS_SHARD_SLOTS. Any patient, appointment,
+# record or bill ID therefore names its site without a directory lookup, and
+# adding a site (a new slot) moves no existing rows.
+#
+# HMS_SHARDS is a JSON list, or the path of a JSON file holding one:
+#   [{"site": "north", "slot": 1, "host": "10.0.1.5", "replicas": "10.0.1.6:3306:1"},
+#    {"site": "south", "slot": 2, "host": "10.0.2.5"}]
+# Entries may also set port, user, password and database. Without HMS_SHARDS
+# there is a single site built from db.DB_CONFIG.
+SHARD_SLOTS = int(os.environ.get('HMS_SHARD_SLOTS', 1))
+
+SHARDS = []
+_by_slot = {}
+_by_site = {}
+_current = contextvars.ContextVar('db_shard', default=None)
+_pool = None
+_pool_lock = threading.Lock()
+
+def _load_config():
+    raw = os.environ.get('HMS_SHARDS', '').strip()
+    if not raw:
+        return None
+    if raw.startswith('['):
+        return json.loads(raw)
+    with open(raw) as f:
+        return json.load(f)
+
+def configure(primary, replicas):
+    # Called once by db.py with its connection settings.
+    import routing
+
+    entries = _load_config()
+    if entries is None:
+        shards = [{'site': 'default', 'slot': 0, 'config': dict(primary), 'replicas': replicas}]
+    else:
+        shards = []
+        for entry in entries:
+            config = dict(primary)
+            for key in ('host', 'port', 'user', 'password', 'database'):
+                if key in entry:
+                    config[key] = entry[key]
+            shards.append({
+                'site': entry['site'],
+                'slot': entry['slot'],
+                'config': config,
+                'replicas': routing.parse_replicas(entry.get('replicas', '')),
+            })
+    by_slot = {}
+    for shard in shards:
+        key = shard['slot'] % SHARD_SLOTS
+        if key in by_slot:
+            raise ValueError(f"Sites {by_slot[key]['site']} and {shard['site']} share slot {key}.")
+        by_slot[key] = shard
+    SHARDS[:] = shards
+    _by_slot.clear()
+    _by_slot.update(by_slot)
+    _by_site.clear()
+    _by_site.update({shard['site']: shard for shard in shards})
+
+def current():
+    return _current.get() or SHARDS[0]
+
+def home():
+    # Site that takes reference-data writes first and holds the audit log.
+    return SHARDS[0]
+
+@contextmanager
+def use(shard):
+    token = _current.set(shard)
+    try:
+        yield shard
+    finally:
+        _current.reset(token)
+
+class UnknownSite(ValueError):
+    # An ID no configured site generates (e.g. 0 typed into a form), or a
+    # site name that is not configured. HMS.py shows the message.
+    pass
+
+class BroadcastIncomplete(Exception):
+    # A reference-data write committed on the home site but failed on some
+    # of the others; `result` is what the home site returned and `failed`
+    # is [(site, error)]. Re-running the write on those sites brings them
+    # back in step.
+    def __init__(self, result, failed):
+        super().__init__("Not saved on site(s) %s." % ", ".join(site for site, error in failed))
+        self.result = result
+        self.failed = failed
+
+def shard_for_id(entity_id):
+    try:
+        return _by_slot[int(entity_id) % SHARD_SLOTS]
+    except KeyError:
+        raise UnknownSite(f"No site owns ID {entity_id}.")
+
+def shard_for_site(site):
+    try:
+        return _by_site[site]
+    except KeyError:
+        raise UnknownSite(f"No site named {site}.")
+
+def shard_for_new_patient(data):
+    if data.get('site'):
+        return _by_site[data['site']]
+    # Hashing the email keeps re-registrations of the same person on one site,
+    # where dedup.py can find them.
+    key = (data.get('email') or '').strip().lower().encode()
+    return SHARDS[zlib.crc32(key) % len(SHARDS)]
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(4, 2 * len(SHARDS)), thread_name_prefix="shard")
+    return _pool
+
+def run_all(fn):
+    # fn() once per site, in parallel; returns the results in SHARDS order.
+    # The caller's context (deadline, read routing, session) goes with it.
+    def run_on(shard):
+        with use(shard):
+            return fn()
+    if len(SHARDS) == 1:
+        return [run_on(SHARDS[0])]
+    futures = [_executor().submit(contextvars.copy_context().run, run_on, shard) for shard in SHARDS]
+    return [future.result() for future in futures]
+
+def _concat(results):
+    combined = []
+    for result in results:
+        if result:
+            combined.extend(result)
+    return combined
+
+def routed(argument, item=None):
+    # Runs the call on the site owning the ID in `argument` (or argument[item]
+    # for the data dicts).
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            value = signature.bind(*args, **kwargs).arguments[argument]
+            if item is not None:
+                value = value[item]
+            with use(shard_for_id(value)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def placed(func):
+    # For registrations: picks the site a new patient is created on.
+    @functools.wraps(func)
+    def wrapper(data, *args, **kwargs):
+        with use(shard_for_new_patient(data)):
+            return func(data, *args, **kwargs)
+    return wrapper
+
+def scatter(combine=_concat):
+    # Runs the call on every site and merges the results (lists are
+    # concatenated by default).
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return combine(run_all(lambda: func(*args, **kwargs)))
+        return wrapper
+    return decorate
+
+def broadcast(id_key=None):
+    # Reference-data writes: run on the home site first, then on the others.
+    # For inserts, the ID the home site generated is passed on as
+    # data[id_key] so every site stores the row under the same ID.
+    # Each site commits on its own, so a failure after the home site is not
+    # rolled back: every site is still tried, and the ones that failed are
+    # reported together in BroadcastIncomplete.
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with use(home()):
+                result = func(*args, **kwargs)
+            if id_key is not None:
+                args = (dict(args[0], **{id_key: result}),) + args[1:]
+            failed = []
+            for shard in SHARDS[1:]:
+                try:
+                    with use(shard):
+                        func(*args, **kwargs)
+                except Exception as e:
+                    print(f"{func.__name__} failed on site {shard['site']}: {str(e)}")
+                    failed.append((shard['site'], e))
+            if failed:
+                raise BroadcastIncomplete(result, failed)
+            return result
+        return wrapper
+    return decorate
@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+import cache
+import names
+from models import TimelineEvent
+
+
+@pytest.fixture
+def tables(monkeypatch):
+    monkeypatch.setattr(cache, "sync", lambda: None)
+    monkeypatch.setattr(names, "_tables", {
+        'doctor': names._Names([(7, "Ada Lovelace"), (3, "Alan Turing")]),
+        'patient': names._Names([(11, "Grace Hopper")]),
+    })
+
+
+def test_get_finds_ids_in_sorted_array():
+    table = names._Names([(7, "Ada Lovelace"), (3, "Alan Turing")])
+    assert table.get(3) == "Alan Turing"
+    assert table.get(7) == "Ada Lovelace"
+    assert table.get(5) is None
+    assert table.get(None) is None
+
+
+def test_put_and_remove_keep_the_array_sorted():
+    table = names._Names([(7, "Ada Lovelace")])
+    table.put(3, "Alan Turing")
+    table.put(7, "Ada King")
+    table.remove(9)
+    assert list(table.ids) == [3, 7]
+    assert table.get(7) == "Ada King"
+    table.remove(3)
+    assert table.get(3) is None
+
+
+def test_enrich_adds_names_next_to_id_columns(tables):
+    rows = [{'Appointment_ID': 1, 'Patient_ID': 11, 'Doctor_ID': 3}]
+    assert names.enrich(rows) == [{
+        'Appointment_ID': 1,
+        'Patient_ID': 11, 'Patient_Name': "Grace Hopper",
+        'Doctor_ID': 3, 'Doctor_Name': "Alan Turing",
+    }]
+
+
+def test_enrich_keeps_names_the_query_returned(tables):
+    rows = [{'Doctor_ID': 3, 'Doctor_Name': "Dr Turing"}]
+    assert names.enrich(rows) == rows
+
+
+def test_enrich_row_types_with_missing_ids(tables):
+    at = datetime(2024, 5, 1)
+    events = [
+        TimelineEvent(at, 'record', 4, 7, "flu"),
+        TimelineEvent(at, 'bill', 9, None, "120.00 Unpaid"),
+    ]
+    enriched = names.enrich(events)
+    assert enriched[0]['doctor_name'] == "Ada Lovelace"
+    assert enriched[1]['doctor_id'] is None
+    assert enriched[1]['doctor_name'] is None
+
+
+def test_enrich_passes_other_rows_through(tables):
+    assert names.enrich([]) == []
+    assert names.enrich([(1, 2)]) == [(1, 2)]
@@ -0,0 +1,25 @@
+import routing
+
+_PRIMARY = {'host': 'primary', 'port': 3306}
+_REPLICAS = [{'host': 'replica', 'port': 3306, 'weight': 1.0}]
+
+
+def _connect():
+    return routing.connect(_PRIMARY, lambda config: config['host'], _REPLICAS)
+
+
+def test_reads_go_to_replicas_until_the_session_writes():
+    routing.use_session({})
+    with routing.reading():
+        assert _connect() == 'replica'
+    assert _connect() == 'primary'
+    with routing.reading():
+        assert _connect() == 'primary'
+
+
+def test_primary_reads_do_not_pin_the_session():
+    routing.use_session({})
+    with routing.primary():
+        assert _connect() == 'primary'
+    with routing.reading():
+        assert _connect() == 'replica'
@@ -0,0 +1,106 @@
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+
+import timeline
+
+
+def test_bound_from_the_start_reads_every_real_date():
+    for kind, rank, has_time, sql in timeline._SOURCES:
+        bound = timeline._bound(rank, has_time, timeline._FIRST)
+        assert bound == {'d': date.max, 't': time.min, 'i': 0}
+
+
+def test_bound_same_source_continues_below_the_last_id():
+    after = (datetime(2024, 5, 1), 2, 40)
+    assert timeline._bound(2, False, after) == {'d': date(2024, 5, 1), 't': time.min, 'i': 40}
+
+
+def test_bound_lower_rank_still_owes_the_whole_day():
+    # Records (rank 2) sort before bills (rank 0) on the same day, so after a
+    # record every bill of that day is still to come.
+    after = (datetime(2024, 5, 1), 2, 40)
+    assert timeline._bound(0, False, after)['i'] == timeline._MAX_ID
+
+
+def test_bound_higher_rank_is_done_with_the_day():
+    after = (datetime(2024, 5, 1), 0, 40)
+    assert timeline._bound(2, False, after)['i'] == 0
+
+
+def test_bound_dated_rows_after_a_timed_event():
+    # An appointment at 09:30 comes before everything dated that day.
+    after = (datetime(2024, 5, 1, 9, 30), 3, 40)
+    assert timeline._bound(2, False, after)['i'] == timeline._MAX_ID
+    assert timeline._bound(3, True, after) == {'d': date(2024, 5, 1), 't': time(9, 30), 'i': 40}
+
+
+# (kind, day, time or None, id)
+_ROWS = [
+    ('appointment', date(2024, 5, 1), timedelta(hours=9, minutes=30), 5),
+    ('appointment', date(2024, 5, 1), timedelta(hours=9, minutes=30), 3),
+    ('appointment', date(2024, 5, 1), timedelta(hours=14), 8),
+    ('appointment', date(2024, 4, 2), timedelta(hours=11), 2),
+    ('record', date(2024, 5, 1), None, 41),
+    ('record', date(2024, 5, 1), None, 40),
+    ('record', date(2024, 4, 2), None, 12),
+    ('prescription', date(2024, 5, 1), None, 90),
+    ('prescription', date(2024, 3, 9), None, 61),
+    ('bill', date(2024, 5, 1), None, 7),
+    ('bill', date(2024, 4, 2), None, 6),
+    ('bill', date(2024, 4, 2), None, 4),
+]
+
+
+class _FakeCursor:
+    # Evaluates the keyset conditions of timeline._SOURCES in Python.
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+
+    def execute(self, sql, params):
+        kind = next(kind for kind, rank, has_time, source in timeline._SOURCES if source == sql)
+        d, t, i = params['d'], timedelta(hours=params['t'].hour, minutes=params['t'].minute), params['i']
+        matches = []
+        for row_kind, day, clock, item_id in self.rows:
+            if row_kind != kind:
+                continue
+            if kind == 'appointment':
+                newer = (day, clock, item_id) < (d, t, i)
+            else:
+                newer = (day, item_id) < (d, i)
+            if newer:
+                matches.append((day, clock, item_id, None, None))
+        matches.sort(key=lambda row: (row[0], row[1] or timedelta(0), row[2]), reverse=True)
+        self.result = matches[:params['n']]
+
+    def fetchall(self):
+        return self.result
+
+
+def _ids(events):
+    return [(event.kind, event.item_id) for event in events]
+
+
+def test_stream_merges_sources_newest_first():
+    events = list(timeline.stream(_FakeCursor(_ROWS), 1, chunk=2))
+    assert _ids(events) == [
+        ('appointment', 8), ('appointment', 5), ('appointment', 3),
+        ('record', 41), ('record', 40), ('prescription', 90), ('bill', 7),
+        ('appointment', 2), ('record', 12), ('bill', 6), ('bill', 4),
+        ('prescription', 61),
+    ]
+
+
+def test_pages_resume_from_the_last_key_without_gaps_or_repeats():
+    cursor = _FakeCursor(_ROWS)
+    expected = _ids(timeline.stream(cursor, 1))
+    for page_size in (1, 2, 3, 5):
+        seen = []
+        after = None
+        while True:
+            page = list(islice(timeline.stream(cursor, 1, after, chunk=page_size + 1), page_size))
+            if not page:
+                break
+            seen.extend(_ids(page))
+            after = timeline.key(page[-1])
+        assert seen == expected
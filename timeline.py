@@ -0,0 +1,133 @@
+import heapq
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+
+import audit
+import db
+from models import TimelineEvent
+from resilience import db_call
+from routing import read_call
+from shards import routed
+
+# One newest-first history per patient: appointments, medical records,
+# prescriptions and bills merged by date. Each source is read a chunk at a
+# time in index order, keyset-paged from the last row it returned, and
+# heapq.merge pulls from whichever source is next; a page therefore costs a
+# few short index range reads however long the patient's history is.
+#
+# Position in the stream is the key (at, rank, item_id) of the last event
+# shown. Dated-only rows sit at midnight; on ties the higher rank comes
+# first. Rows without a date are left out.
+
+PAGE_SIZE = 25
+
+_MAX_ID = 2 ** 31
+_FIRST = (datetime.combine(date.max, time.min), -1, 0)
+
+# (kind, rank, has_time, SQL). Each query takes patient, d (date), t (time,
+# appointments only), i (ID bound) and n (limit), and returns date, time,
+# ID, doctor and detail columns ordered newest first.
+_SOURCES = (
+    ('appointment', 3, True, """
+        SELECT Appointment_Date, Appointment_Time, Appointment_ID, Doctor_ID, Appointment_Status
+        FROM Appointments
+        WHERE Patient_ID = %(patient)s
+        AND (Appointment_Date < %(d)s OR (Appointment_Date = %(d)s AND (Appointment_Time < %(t)s
+            OR (Appointment_Time = %(t)s AND Appointment_ID < %(i)s))))
+        ORDER BY Appointment_Date DESC, Appointment_Time DESC, Appointment_ID DESC
+        LIMIT %(n)s
+    """),
+    ('record', 2, False, """
+        SELECT Record_Date, NULL, Record_ID, Doctor_ID, Diagnosis_Summary
+        FROM Medical_Record
+        WHERE Patient_ID = %(patient)s
+        AND (Record_Date < %(d)s OR (Record_Date = %(d)s AND Record_ID < %(i)s))
+        ORDER BY Record_Date DESC, Record_ID DESC
+        LIMIT %(n)s
+    """),
+    # Prescriptions reach the patient through their record, so each chunk
+    # sorts that patient's prescriptions rather than reading an index in order.
+    ('prescription', 1, False, """
+        SELECT p.Start_Date, NULL, p.Prescription_ID, r.Doctor_ID,
+        CONCAT(COALESCE(m.Medicine_Name, CONCAT('medicine ', p.Medicine_ID)), ' x', p.Quantity)
+        FROM Prescriptions AS p
+        INNER JOIN Medical_Record AS r ON r.Record_ID = p.Record_ID
+        LEFT JOIN Medications AS m ON m.Medicine_ID = p.Medicine_ID
+        WHERE r.Patient_ID = %(patient)s
+        AND (p.Start_Date < %(d)s OR (p.Start_Date = %(d)s AND p.Prescription_ID < %(i)s))
+        ORDER BY p.Start_Date DESC, p.Prescription_ID DESC
+        LIMIT %(n)s
+    """),
+    ('bill', 0, False, """
+        SELECT Bill_Date, NULL, Bill_ID, NULL, CONCAT(Amount, ' ', Payment_Status)
+        FROM Bills
+        WHERE Patient_ID = %(patient)s
+        AND (Bill_Date < %(d)s OR (Bill_Date = %(d)s AND Bill_ID < %(i)s))
+        ORDER BY Bill_Date DESC, Bill_ID DESC
+        LIMIT %(n)s
+    """),
+)
+
+_RANKS = {kind: rank for kind, rank, has_time, sql in _SOURCES}
+
+def key(event):
+    return (event.at, _RANKS[event.kind], event.item_id)
+
+def _bound(rank, has_time, after):
+    # Query bound for one source so it returns exactly the events ordered
+    # after `after`.
+    at, after_rank, after_id = after
+    if rank == after_rank:
+        item_bound = after_id
+    elif rank < after_rank:
+        item_bound = _MAX_ID
+    else:
+        item_bound = 0
+    if not has_time and at.time() != time.min:
+        # Everything on that date (at midnight) is already earlier.
+        item_bound = _MAX_ID
+    return {'d': at.date(), 't': at.time(), 'i': item_bound}
+
+def _source(cursor, kind, rank, has_time, sql, patient_id, after, chunk):
+    while True:
+        cursor.execute(sql, dict(_bound(rank, has_time, after), patient=patient_id, n=chunk))
+        rows = cursor.fetchall()
+        for day, clock, item_id, doctor_id, detail in rows:
+            at = datetime.combine(day, time.min) + (clock or timedelta(0))
+            yield TimelineEvent(at, kind, item_id, doctor_id, detail)
+        if len(rows) < chunk:
+            return
+        after = (at, rank, item_id)
+
+def stream(cursor, patient_id, after=None, chunk=PAGE_SIZE + 1):
+    # Lazy merged stream of events after `after` (from the newest when None).
+    # cursor must return plain tuples (db.tuple_cursor).
+    after = after or _FIRST
+    sources = [_source(cursor, kind, rank, has_time, sql, patient_id, after, chunk) for kind, rank, has_time, sql in _SOURCES]
+    return heapq.merge(*sources, key=key, reverse=True)
+
+@db_call
+@read_call
+@routed('patient_id')
+def get_page(patient_id, after=None, page_size=PAGE_SIZE, actor=None):
+    # Returns (events, position of the next page or None).
+    connection = db.get_connection()
+    try:
+        with db.tuple_cursor(connection) as cursor:
+            events = list(islice(stream(cursor, patient_id, after, page_size + 1), page_size + 1))
+    finally:
+        connection.close()
+    more = len(events) > page_size
+    events = events[:page_size]
+    audit.log_many('view', actor, patient_id, [e.item_id for e in events if e.kind == 'record'])
+    return events, (key(events[-1]) if more else None)
+
+def pages(patient_id, page_size=PAGE_SIZE, actor=None):
+    # Pages on demand, newest first; each is read only when asked for.
+    after = None
+    while True:
+        events, after = get_page(patient_id, after, page_size, actor)
+        if events:
+            yield events
+        if after is None:
+            return